@@ -3,9 +3,21 @@
 
 import os
 
-import arcpy
+try:
+    import arcpy
+except ImportError:
+    # No ArcGIS (e.g. Linux build agents): use the NumPy-backed stand-in
+    from _arcemu import install
+    arcpy = install()
+    del install
 
 from _core import *
+from _cache import *
+from _stats import *
+from _matching import *
+from _spatial import *
+from _selection import *
+from _sampling import *
 from _session import *
 from _envs import *
 from _quicktools import *
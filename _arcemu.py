@@ -0,0 +1,1190 @@
+# -*- coding: utf-8 -*-
+"""
+_arcemu.py -- ArcPy Stand-in
+Author: Garin Wally
+License: MIT
+
+A NumPy-backed emulation of the subset of arcpy that ArcHacks uses, for
+running, load-testing and profiling ArcHacks where arcpy is not installed
+(e.g. Linux build agents). `import archacks` selects it automatically when
+arcpy cannot be imported, and the benchmark suite uses it as its reference
+backend.
+
+Covered: da.SearchCursor/UpdateCursor/InsertCursor (OID@, SHAPE@ tokens,
+where clauses and ORDER BY sql_clause), da.TableToNumPyArray/
+NumPyArrayToTable, Describe, ListFields, ListTables, ListFeatureClasses,
+Exists, CreateUniqueName, AddFieldDelimiters, GetCount_management,
+Add/Delete/Calculate/JoinField_management, Append_management,
+CreateFeatureclass_management, CopyFeatures_management,
+TableToTable_conversion, Delete_management, the in_memory workspace and
+simple geometries (Point, Array, PointGeometry, Multipoint, Polyline,
+Polygon).
+Where clauses support =, <>, <, <=, >, >=, IS [NOT] NULL, [NOT] IN,
+[NOT] LIKE (with ESCAPE), [NOT] BETWEEN, AND/OR/NOT, parentheses,
+UPPER/LOWER and date '...' literals.
+
+Tables live in memory only. Each column is a NumPy array; columns holding
+NULLs are object arrays with None, as arcpy's cursors return them. Feature
+classes keep their geometries as objects in a Shape column; SpatialReference
+objects are accepted but nothing is projected, and there are no
+geoprocessing overlays.
+"""
+
+import datetime
+import fnmatch
+import os
+import re
+import sys
+import types
+from collections import OrderedDict
+
+import numpy as np
+
+# Rows converted to Python values at a time by the cursors
+_BLOCK = 10000
+
+# NumPy dtype kind/size to ESRI field type
+_esri_types = {
+    "b": "SmallInteger",
+    "i2": "SmallInteger",
+    "i4": "Integer",
+    "i8": "Integer",
+    "f4": "Single",
+    "f8": "Double",
+    "M": "Date",
+    "U": "String",
+    "S": "String",
+    "O": "String"}
+
+# AddField_management type keywords to ESRI field types
+_add_field_types = {
+    "TEXT": "String",
+    "FLOAT": "Single",
+    "DOUBLE": "Double",
+    "SHORT": "SmallInteger",
+    "LONG": "Integer",
+    "DATE": "Date"}
+
+
+class ExecuteError(Exception):
+    pass
+
+
+class _Env(object):
+    def __init__(self):
+        self.workspace = "in_memory"
+        self.overwriteOutput = True
+
+
+env = _Env()
+
+
+def AddMessage(message):
+    print(message)
+
+
+class Field(object):
+    """Stand-in for arcpy.Field."""
+    def __init__(self, name, type="String", length=255, editable=True,
+                 isNullable=True, required=False, aliasName=None):
+        self.name = name
+        self.baseName = name
+        self.aliasName = aliasName or name
+        self.type = type
+        self.length = length
+        self.editable = editable
+        self.isNullable = isNullable
+        self.required = required
+
+    def __repr__(self):
+        return "<Field {} ({})>".format(self.name, self.type)
+
+
+class _Table(object):
+    """An in-memory table: ordered fields and one array per field."""
+    def __init__(self, path):
+        self.path = path
+        self.oid_field = "OBJECTID"
+        self.fields = [Field(self.oid_field, "OID", 4, False, False, True)]
+        self.columns = OrderedDict([(self.oid_field, np.array([], "i4"))])
+        self.shape_type = None
+        self.shape_field = None
+        self._pending = []
+
+    def __len__(self):
+        self.flush()
+        return len(self.columns[self.oid_field])
+
+    def add_field(self, name, esri_type, values, length=255, alias=None):
+        self.fields.append(Field(name, esri_type, length, aliasName=alias))
+        self.columns[name] = values
+        return
+
+    def drop_field(self, name):
+        name = self.index(name)
+        self.fields = [f for f in self.fields if f.name != name]
+        self.columns.pop(name)
+        return
+
+    def index(self, name):
+        """Resolves a field name (case-insensitive, as arcpy does)."""
+        if name.upper() == "OID@":
+            return self.oid_field
+        if name.upper().startswith("SHAPE@") and self.shape_field:
+            return self.shape_field
+        for f in self.columns:
+            if f.lower() == name.lower():
+                return f
+        raise RuntimeError("Cannot find field '{}'".format(name))
+
+    def copy(self, path, rows=None):
+        """Copy of the table (only the row positions in rows, if given)."""
+        self.flush()
+        new = _Table(path)
+        new.shape_type = self.shape_type
+        new.shape_field = self.shape_field
+        new.fields = [Field(f.name, f.type, f.length, f.editable,
+                            f.isNullable, f.required, f.aliasName)
+                      for f in self.fields]
+        for name, col in self.columns.items():
+            new.columns[name] = (col if rows is None else col[rows]).copy()
+        new.columns[new.oid_field] = np.arange(
+            1, len(new.columns[new.oid_field]) + 1, dtype="i4")
+        return new
+
+    def flush(self):
+        """Appends rows staged by InsertCursors to the column arrays."""
+        if not self._pending:
+            return
+        rows = self._pending
+        self._pending = []
+        oids = self.columns[self.oid_field]
+        # OIDs are not reused after deletes
+        start = int(oids.max()) + 1 if len(oids) else 1
+        for name, values in zip(list(self.columns.keys()), zip(*rows)):
+            old = self.columns[name]
+            if name == self.oid_field:
+                new = np.arange(start, start + len(rows), dtype="i4")
+            else:
+                new = _to_array(values, old.dtype)
+            if new.dtype != old.dtype:
+                old = _to_array(old, object)
+            self.columns[name] = np.concatenate([old, new])
+        return
+
+    def set(self, name, i, value):
+        """Sets a single value, allowing NULLs in typed columns."""
+        col = self.columns[name]
+        if value is None and col.dtype != object:
+            col = col.astype(object)
+            self.columns[name] = col
+        col[i] = value
+        return
+
+
+def _to_array(values, dtype=None):
+    """Array of cursor values in dtype if possible, else of objects."""
+    if dtype is not None and dtype != object and None not in values:
+        try:
+            return np.array(values, dtype=dtype)
+        except (TypeError, ValueError):
+            pass
+    a = np.empty(len(values), dtype=object)
+    try:
+        a[:] = list(values)
+    except ValueError:
+        # Sequences such as (x, y) tuples are kept as single values
+        for i, v in enumerate(values):
+            a[i] = v
+    return a
+
+
+def _notnull(values):
+    """Boolean mask of the non-NULL values of a column."""
+    if values.dtype == object:
+        return np.not_equal(values, None)
+    return np.ones(len(values), dtype=bool)
+
+
+# Tables by lower-case path
+_tables = {}
+
+
+def _path(tbl):
+    """Normalizes a table name or path; bare names are in env.workspace."""
+    tbl = str(tbl).replace("\\", "/")
+    if "/" not in tbl:
+        tbl = "{}/{}".format(env.workspace, tbl)
+    return tbl
+
+
+def _get(tbl):
+    try:
+        return _tables[_path(tbl).lower()]
+    except KeyError:
+        raise ExecuteError("Dataset {} does not exist".format(tbl))
+
+
+# =============================================================================
+# WHERE CLAUSES
+
+_token_re = re.compile(r"""\s*(?:
+    (?P<str>'(?:[^']|'')*')|
+    (?P<num>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)|
+    (?P<name>"[^"]+"|\[[^\]]+\])|
+    (?P<op><>|!=|<=|>=|=|<|>|\(|\)|,)|
+    (?P<word>[A-Za-z_][\w.$@]*)
+    )""", re.X)
+
+_keywords = ("AND", "OR", "NOT", "IS", "NULL", "IN", "LIKE", "ESCAPE",
+             "BETWEEN", "DATE", "TIMESTAMP", "UPPER", "LOWER")
+
+_compare_ops = {
+    "=": np.equal,
+    "<>": np.not_equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal}
+
+# Comparison to use when the operands are swapped (e.g. 5 < field)
+_swapped_ops = {
+    np.less: np.greater,
+    np.greater: np.less,
+    np.less_equal: np.greater_equal,
+    np.greater_equal: np.less_equal}
+
+
+def _tokenize(where):
+    tokens = []
+    where = where.strip()
+    pos = 0
+    while pos < len(where):
+        m = _token_re.match(where, pos)
+        if not m or m.end() == pos:
+            raise RuntimeError(
+                "Invalid where clause near: {}".format(where[pos:]))
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "word" and value.upper() in _keywords:
+            kind, value = "kw", value.upper()
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+
+def _parse_date(text):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%m/%d/%Y %H:%M:%S",
+                "%m/%d/%Y"):
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise RuntimeError("Invalid date: {}".format(text))
+
+
+def _like_regex(pattern, escape=None):
+    """Compiles a SQL LIKE pattern (% and _ wildcards, and an optional
+    escape character that makes the next character literal).
+    """
+    regex = []
+    chars = iter(pattern)
+    for c in chars:
+        if c == escape:
+            regex.append(re.escape(next(chars, "")))
+        elif c == "%":
+            regex.append(".*")
+        elif c == "_":
+            regex.append(".")
+        else:
+            regex.append(re.escape(c))
+    return re.compile("".join(regex) + r"\Z", re.S)
+
+
+class _Where(object):
+    """Recursive-descent evaluator of a where clause over a table's columns.
+    Conditions evaluate to boolean masks; NULLs never match (as in SQL).
+    """
+    def __init__(self, table, where):
+        self.table = table
+        self.n = len(table)
+        self.tokens = _tokenize(where)
+        self.pos = 0
+
+    def mask(self):
+        result = self._or()
+        if self.pos != len(self.tokens):
+            raise RuntimeError("Invalid where clause near: {}".format(
+                self.tokens[self.pos][1]))
+        return self._full(result)
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def _take(self, value=None):
+        token = self._peek()
+        if value is not None and token[1] != value:
+            raise RuntimeError("Expected {} in where clause".format(value))
+        self.pos += 1
+        return token
+
+    def _full(self, result):
+        """Broadcasts a scalar condition (e.g. 1=1) to a mask."""
+        if np.ndim(result) == 0:
+            return np.repeat(bool(result), self.n)
+        return np.asarray(result, dtype=bool)
+
+    def _or(self):
+        result = self._and()
+        while self._peek() == ("kw", "OR"):
+            self._take()
+            result = self._full(result) | self._full(self._and())
+        return result
+
+    def _and(self):
+        result = self._not()
+        while self._peek() == ("kw", "AND"):
+            self._take()
+            result = self._full(result) & self._full(self._not())
+        return result
+
+    def _not(self):
+        if self._peek() == ("kw", "NOT"):
+            self._take()
+            return ~self._full(self._not())
+        if self._peek() == ("op", "("):
+            self._take()
+            result = self._or()
+            self._take(")")
+            return result
+        return self._predicate()
+
+    def _operand(self):
+        """A literal (Python value) or a field (column array)."""
+        kind, value = self._take()
+        if kind == "str":
+            return value[1:-1].replace("''", "'")
+        if kind == "num":
+            if re.search("[.eE]", value):
+                return float(value)
+            return int(value)
+        if kind in ("name", "word"):
+            name = value[1:-1] if kind == "name" else value
+            return self.table.columns[self.table.index(name)]
+        if kind == "kw" and value in ("DATE", "TIMESTAMP"):
+            return _parse_date(self._operand())
+        if kind == "kw" and value in ("UPPER", "LOWER"):
+            self._take("(")
+            values = self._operand()
+            self._take(")")
+            if value == "UPPER":
+                func = lambda v: v.upper()
+            else:
+                func = lambda v: v.lower()
+            if not isinstance(values, np.ndarray):
+                return func(values)
+            return _to_array([None if v is None else func(v)
+                              for v in values.tolist()])
+        raise RuntimeError("Invalid where clause near: {}".format(value))
+
+    def _predicate(self):
+        left = self._operand()
+        if self._peek() == ("kw", "IS"):
+            self._take()
+            negate = self._peek() == ("kw", "NOT")
+            if negate:
+                self._take()
+            self._take("NULL")
+            if isinstance(left, np.ndarray):
+                isnull = ~_notnull(left)
+            else:
+                isnull = left is None
+            return ~isnull if negate else isnull
+        negate = self._peek() == ("kw", "NOT")
+        if negate:
+            self._take()
+        op = self._take()[1]
+        if op == "IN":
+            self._take("(")
+            values = [self._operand()]
+            while self._peek() == ("op", ","):
+                self._take()
+                values.append(self._operand())
+            self._take(")")
+            result = self._apply(left, lambda a: np.array(
+                [v in values for v in a.tolist()], dtype=bool))
+        elif op == "LIKE":
+            pattern = self._operand()
+            escape = None
+            if self._peek() == ("kw", "ESCAPE"):
+                self._take()
+                escape = self._operand()
+            pattern = _like_regex(pattern, escape)
+            result = self._apply(left, lambda a: np.array(
+                [pattern.match(v) is not None for v in a.tolist()],
+                dtype=bool))
+        elif op == "BETWEEN":
+            low = self._operand()
+            self._take("AND")
+            high = self._operand()
+            result = self._apply(left, lambda a: (a >= low) & (a <= high))
+        elif op in _compare_ops:
+            result = self._compare(left, _compare_ops[op], self._operand())
+        else:
+            raise RuntimeError("Invalid where clause near: {}".format(op))
+        if negate:
+            # NOT keeps NULLs excluded
+            if isinstance(left, np.ndarray):
+                return ~self._full(result) & _notnull(left)
+            return not result
+        return result
+
+    def _apply(self, values, func):
+        """Applies func to the non-NULL values of a column."""
+        if not isinstance(values, np.ndarray):
+            return bool(func(np.array([values], dtype=object))[0])
+        result = np.zeros(len(values), dtype=bool)
+        valid = _notnull(values)
+        if valid.any():
+            result[valid] = func(values[valid])
+        return result
+
+    def _compare(self, left, op, right):
+        if isinstance(left, np.ndarray) and isinstance(right, np.ndarray):
+            valid = _notnull(left) & _notnull(right)
+            result = np.zeros(len(left), dtype=bool)
+            result[valid] = op(left[valid], right[valid])
+            return result
+        if isinstance(right, np.ndarray):
+            left, right = right, left
+            op = _swapped_ops.get(op, op)
+        return self._apply(left, lambda a: op(a, right))
+
+
+def _where_rows(table, where_clause):
+    """Positions of the rows matching a where clause (None for all rows)."""
+    if not where_clause:
+        return None
+    return np.flatnonzero(_Where(table, where_clause).mask())
+
+
+def _order_rows(table, rows, sql_clause):
+    """Orders row positions by an 'ORDER BY f [ASC|DESC], ...' postfix."""
+    postfix = (sql_clause or (None, None))[1]
+    m = re.match(r"\s*ORDER\s+BY\s+(.+)", postfix or "", re.I)
+    if not m:
+        return rows
+    if rows is None:
+        rows = np.arange(len(table))
+    # Stable sorts from the last key to the first
+    for part in reversed(m.group(1).split(",")):
+        words = part.split()
+        col = table.columns[table.index(words[0].strip('"[]'))][rows].tolist()
+        desc = len(words) > 1 and words[1].upper() == "DESC"
+        # NULLs sort last ascending, first descending
+        order = sorted(range(len(rows)),
+                       key=lambda i: (col[i] is None, col[i]), reverse=desc)
+        rows = rows[order]
+    return rows
+
+
+# =============================================================================
+# GEOMETRY
+
+class Point(object):
+    """Stand-in for arcpy.Point."""
+    def __init__(self, X=0.0, Y=0.0, Z=None, M=None, ID=0):
+        self.X = X
+        self.Y = Y
+        self.Z = Z
+        self.M = M
+        self.ID = ID
+
+    def __repr__(self):
+        return "<Point {} {}>".format(self.X, self.Y)
+
+
+class Array(list):
+    """Stand-in for arcpy.Array (a list of Points, Arrays or None)."""
+    def __init__(self, items=None):
+        if isinstance(items, Point):
+            items = [items]
+        list.__init__(self, items or [])
+
+    def add(self, value):
+        self.append(value)
+
+    @property
+    def count(self):
+        return len(self)
+
+
+class SpatialReference(object):
+    """Stand-in for arcpy.SpatialReference; coordinates are never projected."""
+    def __init__(self, item=None):
+        self.factoryCode = item if isinstance(item, int) else 0
+        self.name = str(item)
+
+
+class Extent(object):
+    def __init__(self, XMin=None, YMin=None, XMax=None, YMax=None):
+        self.XMin = XMin
+        self.YMin = YMin
+        self.XMax = XMax
+        self.YMax = YMax
+        if XMin is not None:
+            self.width = XMax - XMin
+            self.height = YMax - YMin
+
+
+def _rings(value):
+    """Splits geometry input (Points, Arrays of Points or of Arrays, None as
+    ring separator) into lists of (x, y) tuples.
+    """
+    if isinstance(value, Point):
+        return [[(value.X, value.Y)]]
+    rings = []
+    ring = []
+    for item in value or []:
+        if isinstance(item, Point):
+            ring.append((item.X, item.Y))
+            continue
+        if ring:
+            rings.append(ring)
+        ring = []
+        if item is not None:
+            rings.extend(_rings(item))
+    if ring:
+        rings.append(ring)
+    return rings
+
+
+class _Geometry(object):
+    """Base of the geometry stand-ins: rings of (x, y) vertex tuples."""
+    type = None
+
+    def __init__(self, inputs, spatial_reference=None):
+        self.rings = _rings(inputs)
+        self.spatialReference = spatial_reference
+        if self.type == "polygon":
+            self.rings = [r if r[0] == r[-1] else r + [r[0]]
+                          for r in self.rings if len(r) > 2]
+
+    def __iter__(self):
+        for ring in self.rings:
+            yield Array([Point(x, y) for x, y in ring])
+
+    def getPart(self, index=None):
+        parts = list(self)
+        return parts if index is None else parts[index]
+
+    @property
+    def partCount(self):
+        return len(self.rings)
+
+    @property
+    def pointCount(self):
+        return sum(len(r) for r in self.rings)
+
+    @property
+    def firstPoint(self):
+        return Point(*self.rings[0][0]) if self.rings else None
+
+    @property
+    def lastPoint(self):
+        return Point(*self.rings[-1][-1]) if self.rings else None
+
+    @property
+    def extent(self):
+        if not self.rings:
+            return Extent()
+        xy = np.array([p for r in self.rings for p in r], dtype="f8")
+        return Extent(*(xy.min(axis=0).tolist() + xy.max(axis=0).tolist()))
+
+    @property
+    def area(self):
+        if self.type != "polygon":
+            return 0.0
+        return float(abs(sum(_ring_area(r)[0] for r in self.rings)))
+
+    @property
+    def length(self):
+        total = 0.0
+        for r in self.rings:
+            xy = np.array(r, dtype="f8")
+            total += np.hypot(*np.diff(xy, axis=0).T).sum()
+        return float(total)
+
+    @property
+    def centroid(self):
+        if not self.rings:
+            return None
+        if self.type == "polygon":
+            parts = [_ring_area(r) for r in self.rings]
+            area = sum(a for a, x, y in parts)
+            if area:
+                return Point(float(sum(a * x for a, x, y in parts) / area),
+                             float(sum(a * y for a, x, y in parts) / area))
+        xy = np.array([p for r in self.rings for p in r], dtype="f8")
+        return Point(*xy.mean(axis=0).tolist())
+
+    trueCentroid = centroid
+
+    @property
+    def labelPoint(self):
+        return self.centroid
+
+    def __repr__(self):
+        return "<{} ({} parts)>".format(type(self).__name__, self.partCount)
+
+
+def _ring_area(ring):
+    """Signed area and centroid (x, y) of a closed ring."""
+    xy = np.array(ring, dtype="f8")
+    x0, y0 = xy[:-1, 0], xy[:-1, 1]
+    x1, y1 = xy[1:, 0], xy[1:, 1]
+    cross = x0 * y1 - x1 * y0
+    area = cross.sum() / 2.0
+    if not area:
+        return 0.0, x0.mean(), y0.mean()
+    return (area, ((x0 + x1) * cross).sum() / (6 * area),
+            ((y0 + y1) * cross).sum() / (6 * area))
+
+
+class PointGeometry(_Geometry):
+    type = "point"
+
+    def __iter__(self):
+        return iter([self.firstPoint])
+
+
+class Multipoint(_Geometry):
+    type = "multipoint"
+
+    def __iter__(self):
+        return iter([Point(x, y) for r in self.rings for x, y in r])
+
+
+class Polyline(_Geometry):
+    type = "polyline"
+
+
+class Polygon(_Geometry):
+    type = "polygon"
+
+
+_geometry_types = {
+    "POINT": PointGeometry,
+    "MULTIPOINT": Multipoint,
+    "POLYLINE": Polyline,
+    "POLYGON": Polygon}
+
+
+def _shape_value(token, geometry):
+    """Reads a SHAPE@ token from a geometry, as arcpy's cursors do."""
+    if geometry is None or token == "SHAPE@":
+        return geometry
+    if token in ("SHAPE@XY", "SHAPE@TRUECENTROID"):
+        c = geometry.centroid
+        return (c.X, c.Y)
+    if token == "SHAPE@X":
+        return geometry.centroid.X
+    if token == "SHAPE@Y":
+        return geometry.centroid.Y
+    if token == "SHAPE@AREA":
+        return geometry.area
+    if token == "SHAPE@LENGTH":
+        return geometry.length
+    raise RuntimeError("Unsupported token {}".format(token))
+
+
+def _shape_input(token, table, value):
+    """Geometry to store for a value written through a SHAPE@ token."""
+    if value is None or isinstance(value, _Geometry):
+        return value
+    if token in ("SHAPE@XY", "SHAPE@TRUECENTROID"):
+        point = Point(*value)
+    else:
+        point = value
+    return _geometry_types[table.shape_type.upper()](point)
+
+
+# =============================================================================
+# DESCRIBE / GEOPROCESSING
+
+class _Describe(object):
+    def __init__(self, table):
+        self.catalogPath = table.path
+        self.path, self.name = os.path.split(table.path)
+        self.baseName = self.name
+        self.dataType = "FeatureClass" if table.shape_type else "Table"
+        self.OIDFieldName = table.oid_field
+        self.hasOID = True
+        self.fields = list(table.fields)
+        if table.shape_type:
+            self.shapeType = table.shape_type
+            self.shapeFieldName = table.shape_field
+
+
+def Describe(tbl):
+    return _Describe(_get(tbl))
+
+
+def ListFields(dataset, wild_card=None, field_type=None):
+    fields = _get(dataset).fields
+    if wild_card:
+        fields = [f for f in fields
+                  if fnmatch.fnmatch(f.name.lower(), wild_card.lower())]
+    if field_type and field_type.upper() != "ALL":
+        fields = [f for f in fields if f.type.upper() == field_type.upper()]
+    return list(fields)
+
+
+def _list_workspace(wild_card, spatial):
+    prefix = "{}/".format(env.workspace.replace("\\", "/")).lower()
+    names = [t.path.split("/")[-1] for k, t in sorted(_tables.items())
+             if k.startswith(prefix) and "/" not in k[len(prefix):]
+             and bool(t.shape_type) == spatial]
+    if wild_card:
+        names = [n for n in names
+                 if fnmatch.fnmatch(n.lower(), wild_card.lower())]
+    return names
+
+
+def ListTables(wild_card=None, table_type=None):
+    return _list_workspace(wild_card, False)
+
+
+def ListFeatureClasses(wild_card=None, feature_type=None,
+                       feature_dataset=None):
+    names = _list_workspace(wild_card, True)
+    if feature_type and feature_type.upper() != "ALL":
+        names = [n for n in names if _get(n).shape_type.upper()
+                 == feature_type.upper()]
+    return names
+
+
+def ListRasters(wild_card=None, raster_type=None):
+    return []
+
+
+def AddFieldDelimiters(datasource, field):
+    return '"{}"'.format(field)
+
+
+def Exists(dataset):
+    return _path(dataset).lower() in _tables
+
+
+def CreateUniqueName(base_name, workspace=None):
+    """A path in workspace (default env.workspace) that does not exist yet,
+    numbering base_name as arcpy does.
+    """
+    workspace = (workspace or env.workspace).replace("\\", "/")
+    name, ext = os.path.splitext(base_name)
+    path = "{}/{}".format(workspace, base_name)
+    i = 0
+    while Exists(path):
+        path = "{}/{}{}{}".format(workspace, name, i, ext)
+        i += 1
+    return path
+
+
+class _Result(object):
+    def __init__(self, *outputs):
+        self._outputs = outputs
+
+    def getOutput(self, i):
+        return self._outputs[i]
+
+
+def GetCount_management(tbl):
+    return _Result(str(len(_get(tbl))))
+
+
+def RefreshCatalog(path):
+    return
+
+
+def Delete_management(in_data, data_type=None):
+    _get(in_data)
+    _tables.pop(_path(in_data).lower())
+    return _Result(in_data)
+
+
+def TableToTable_conversion(in_rows, out_path, out_name, where_clause=None,
+                            *args, **kwargs):
+    table = _get(in_rows)
+    path = "{}/{}".format(out_path.replace("\\", "/"), out_name)
+    _tables[path.lower()] = table.copy(path, _where_rows(table, where_clause))
+    return _Result(path)
+
+
+def Append_management(inputs, target, schema_type="TEST", *args, **kwargs):
+    """Appends the rows of inputs to target, matching fields by name."""
+    table = _get(target)
+    table.flush()
+    if not isinstance(inputs, (list, tuple)):
+        inputs = inputs.split(";")
+    for in_rows in inputs:
+        other = _get(in_rows)
+        other.flush()
+        n = len(other.columns[other.oid_field])
+        oids = table.columns[table.oid_field]
+        start = int(oids.max()) + 1 if len(oids) else 1
+        names = dict((f.lower(), f) for f in other.columns
+                     if f != other.oid_field)
+        for name in list(table.columns.keys()):
+            old = table.columns[name]
+            if name == table.oid_field:
+                new = np.arange(start, start + n, dtype="i4")
+            elif name.lower() in names:
+                new = _to_array(other.columns[names[name.lower()]].tolist(),
+                                old.dtype)
+            else:
+                new = np.empty(n, dtype=object)
+            if new.dtype != old.dtype:
+                old = _to_array(old, object)
+                new = _to_array(new, object)
+            table.columns[name] = np.concatenate([old, new])
+    return _Result(target)
+
+
+def CreateFeatureclass_management(out_path, out_name, geometry_type="POLYGON",
+                                  *args, **kwargs):
+    path = "{}/{}".format(out_path.replace("\\", "/"), out_name)
+    table = _Table(path)
+    table.shape_type = _geometry_types[geometry_type.upper()].type.title()
+    table.shape_field = "Shape"
+    table.add_field("Shape", "Geometry", np.array([], dtype=object))
+    _tables[path.lower()] = table
+    return _Result(path)
+
+
+def CopyFeatures_management(in_features, out_feature_class, *args, **kwargs):
+    table = _get(in_features)
+    path = _path(out_feature_class)
+    _tables[path.lower()] = table.copy(path)
+    return _Result(path)
+
+
+def FeatureClassToFeatureClass_conversion(in_features, out_path, out_name,
+                                          where_clause=None, *args, **kwargs):
+    return TableToTable_conversion(in_features, out_path, out_name,
+                                   where_clause)
+
+
+def AddField_management(in_table, field_name, field_type,
+                        field_precision=None, field_scale=None,
+                        field_length=None, field_alias=None, *args, **kwargs):
+    table = _get(in_table)
+    if field_name.lower() in [f.lower() for f in table.columns]:
+        raise ExecuteError("Field {} already exists".format(field_name))
+    table.add_field(
+        field_name, _add_field_types.get(field_type.upper(), field_type),
+        np.empty(len(table), dtype=object), field_length or 255, field_alias)
+    return _Result(in_table)
+
+
+def DeleteField_management(in_table, drop_field):
+    table = _get(in_table)
+    if not isinstance(drop_field, (list, tuple)):
+        drop_field = drop_field.split(";")
+    for name in drop_field:
+        if table.index(name) == table.oid_field:
+            raise ExecuteError("Cannot delete required field {}".format(name))
+        table.drop_field(name)
+    return _Result(in_table)
+
+
+def CalculateField_management(in_table, field, expression,
+                              expression_type="PYTHON", code_block=""):
+    """Evaluates a Python expression (fields as !name!) for every row."""
+    table = _get(in_table)
+    names = re.findall(r"!([^!]+)!", expression)
+    expression = re.sub(r"!([^!]+)!",
+                        lambda m: "_row[{!r}]".format(m.group(1)), expression)
+    scope = {}
+    if code_block:
+        exec(code_block, scope)
+    compiled = compile(expression, "<expression>", "eval")
+    cols = [table.columns[table.index(n)].tolist() for n in names]
+    target = table.index(field)
+    for i in range(len(table)):
+        scope["_row"] = dict(zip(names, [c[i] for c in cols]))
+        table.set(target, i, eval(compiled, scope))
+    return _Result(in_table)
+
+
+def JoinField_management(in_data, in_field, join_table, join_field,
+                         fields=None):
+    """Permanently joins fields of join_table (first match of each key)."""
+    table = _get(in_data)
+    other = _get(join_table)
+    other.flush()
+    join_field = other.index(join_field)
+    first = {}
+    for i, key in enumerate(other.columns[join_field].tolist()):
+        first.setdefault(key, i)
+    match = [first.get(k) for k
+             in table.columns[table.index(in_field)].tolist()]
+    found = np.array([m is not None for m in match], dtype=bool)
+    positions = np.array([m or 0 for m in match], dtype=int)
+    if fields is None:
+        fields = [f.name for f in other.fields
+                  if f.name not in (other.oid_field, join_field)]
+    for name in fields:
+        source = [f for f in other.fields if f.name == other.index(name)][0]
+        values = _to_array(other.columns[source.name], object)
+        joined = np.empty(len(match), dtype=object)
+        joined[found] = values[positions[found]]
+        out_name = source.name
+        i = 0
+        while out_name.lower() in [c.lower() for c in table.columns]:
+            i += 1
+            out_name = "{}_{}".format(source.name, i)
+        table.add_field(out_name, source.type, joined, source.length)
+    return _Result(in_data)
+
+
+# =============================================================================
+# DATA ACCESS
+
+class _Cursor(object):
+    def __init__(self, tbl, field_names):
+        self._table = _get(tbl)
+        self._table.flush()
+        if field_names in ("*", ["*"]):
+            field_names = list(self._table.columns.keys())
+        if not isinstance(field_names, (list, tuple)):
+            field_names = [field_names]
+        self.fields = tuple(field_names)
+        self._names = [self._table.index(f) for f in self.fields]
+        # Positions of SHAPE@ tokens, converted to and from geometries
+        self._shapes = [(i, f.upper()) for i, f in enumerate(self.fields)
+                        if f.upper().startswith("SHAPE@")]
+
+    def _read(self, block):
+        """Converts a block of rows' SHAPE@ values."""
+        if not self._shapes:
+            return block
+        rows = []
+        for row in block:
+            row = list(row)
+            for i, token in self._shapes:
+                row[i] = _shape_value(token, row[i])
+            rows.append(tuple(row))
+        return rows
+
+    def _write(self, row):
+        row = list(row)
+        for i, token in self._shapes:
+            row[i] = _shape_input(token, self._table, row[i])
+        return row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def reset(self):
+        return
+
+
+class SearchCursor(_Cursor):
+    """Stand-in for arcpy.da.SearchCursor."""
+    def __init__(self, in_table, field_names, where_clause=None,
+                 spatial_reference=None, explode_to_points=False,
+                 sql_clause=(None, None)):
+        _Cursor.__init__(self, in_table, field_names)
+        self._where = where_clause
+        self._sql = sql_clause
+        self._rows = None
+        self._i = -1
+
+    def _iter_rows(self):
+        cols = [self._table.columns[n] for n in self._names]
+        rows = _order_rows(self._table,
+                           _where_rows(self._table, self._where), self._sql)
+        if rows is None:
+            # Unfiltered reads slice the columns directly
+            for start in range(0, len(self._table), _BLOCK):
+                block = self._read(
+                    zip(*[c[start:start + _BLOCK].tolist() for c in cols]))
+                for i, row in enumerate(block, start):
+                    self._i = i
+                    yield row
+            return
+        for start in range(0, len(rows), _BLOCK):
+            positions = rows[start:start + _BLOCK]
+            block = self._read(zip(*[c[positions].tolist() for c in cols]))
+            for i, row in zip(positions.tolist(), block):
+                self._i = i
+                yield row
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._rows is None:
+            self._rows = self._iter_rows()
+        return next(self._rows)
+
+    __next__ = next
+
+    def reset(self):
+        self._rows = None
+        return
+
+
+class UpdateCursor(SearchCursor):
+    """Stand-in for arcpy.da.UpdateCursor."""
+    def __init__(self, in_table, field_names, where_clause=None,
+                 spatial_reference=None, explode_to_points=False,
+                 sql_clause=(None, None)):
+        SearchCursor.__init__(self, in_table, field_names, where_clause,
+                              spatial_reference, explode_to_points,
+                              sql_clause)
+        self._deleted = []
+
+    def next(self):
+        try:
+            return list(SearchCursor.next(self))
+        except StopIteration:
+            self.reset()
+            raise
+
+    __next__ = next
+
+    def updateRow(self, row):
+        for name, value in zip(self._names, self._write(row)):
+            if name != self._table.oid_field:
+                self._table.set(name, self._i, value)
+        return
+
+    def deleteRow(self):
+        self._deleted.append(self._i)
+        return
+
+    def reset(self):
+        """Restarts the cursor, removing the rows deleted so far."""
+        if self._deleted:
+            keep = np.ones(len(self._table), dtype=bool)
+            keep[self._deleted] = False
+            for name, col in self._table.columns.items():
+                self._table.columns[name] = col[keep]
+            self._deleted = []
+        self._rows = None
+        return
+
+
+class InsertCursor(_Cursor):
+    """Stand-in for arcpy.da.InsertCursor."""
+    def insertRow(self, row):
+        values = dict(zip(self._names, self._write(row)))
+        self._table._pending.append(
+            [values.get(n) for n in self._table.columns])
+        return
+
+    def reset(self):
+        self._table.flush()
+
+
+def NumPyArrayToTable(in_array, out_table):
+    """Creates a table from a structured array."""
+    path = _path(out_table)
+    if path.lower() in _tables and not env.overwriteOutput:
+        raise ExecuteError("{} already exists".format(out_table))
+    table = _Table(path)
+    table.columns[table.oid_field] = np.arange(1, len(in_array) + 1,
+                                               dtype="i4")
+    for name in in_array.dtype.names:
+        dtype = in_array.dtype[name]
+        esri_type = _esri_types.get(dtype.kind + str(dtype.itemsize),
+                                    _esri_types.get(dtype.kind, "String"))
+        values = in_array[name]
+        length = 255
+        if dtype.kind == "M":
+            values = values.astype("M8[us]").astype(object)
+        elif dtype.kind in "US":
+            length = max(1, dtype.itemsize // (4 if dtype.kind == "U" else 1))
+            values = values.astype(object)
+        elif dtype.kind == "b":
+            values = values.astype("i2")
+        table.add_field(name, esri_type, np.array(values), length)
+    _tables[path.lower()] = table
+    return
+
+
+def TableToNumPyArray(in_table, field_names, where_clause=None,
+                      skip_nulls=False, null_value=None):
+    """Reads a table into a structured array.
+    As with arcpy, NULLs must be skipped (skip_nulls) or replaced (null_value,
+    a value or a {field: value} dict), else a RuntimeError is raised.
+    """
+    cur = SearchCursor(in_table, field_names)
+    table = cur._table
+    rows = _where_rows(table, where_clause)
+    cols = [table.columns[n] if rows is None else table.columns[n][rows]
+            for n in cur._names]
+    for i, token in cur._shapes:
+        cols[i] = _to_array([_shape_value(token, g) for g in cols[i].tolist()])
+    if skip_nulls and cols:
+        keep = np.logical_and.reduce([_notnull(c) for c in cols])
+        cols = [c[keep] for c in cols]
+    by_name = dict((f.name, f) for f in table.fields)
+    spec = []
+    for i, (name, real_name) in enumerate(zip(cur.fields, cur._names)):
+        field = by_name[real_name]
+        col = cols[i]
+        nulls = ~_notnull(col)
+        if nulls.any():
+            if isinstance(null_value, dict):
+                fill = null_value.get(name)
+            else:
+                fill = null_value
+            if fill is None:
+                raise RuntimeError(
+                    "Field {} has NULL values; use null_value".format(name))
+            col = col.copy()
+            col[nulls] = fill
+            cols[i] = col
+        if name.upper() in ("SHAPE@XY", "SHAPE@TRUECENTROID"):
+            dtype = ("<f8", 2)
+        elif field.type == "Date":
+            dtype = "<M8[us]"
+        elif field.type in ("String", "GUID"):
+            dtype = "<U{}".format(field.length)
+        elif field.type == "OID":
+            dtype = "<i4"
+        elif col.dtype == object:
+            dtype = np.array(col.tolist()).dtype.str
+        else:
+            dtype = col.dtype.str
+        spec.append((str(name), dtype))
+    a = np.zeros(len(cols[0]) if cols else 0, dtype=spec)
+    for (name, _), col in zip(spec, cols):
+        a[name] = col.tolist() if col.dtype == object else col
+    return a
+
+
+# Mirror the arcpy.da submodule
+da = types.ModuleType("arcpy.da")
+da.SearchCursor = SearchCursor
+da.UpdateCursor = UpdateCursor
+da.InsertCursor = InsertCursor
+da.NumPyArrayToTable = NumPyArrayToTable
+da.TableToNumPyArray = TableToNumPyArray
+da.FeatureClassToNumPyArray = TableToNumPyArray
+
+
+def install():
+    """Registers this module as `arcpy` (and `arcpy.da`) for later imports."""
+    module = sys.modules[__name__]
+    sys.modules["arcpy"] = module
+    sys.modules["arcpy.da"] = da
+    return module
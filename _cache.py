@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+_cache.py -- ArcHacks Caches
+Author: Garin Wally
+License: MIT
+
+On-disk snapshots of table reads (tbl2df/ogdb2df) so repeated loads of the
+same, rarely-changing source (e.g. an SDE view) are a memory-map rather than
+a full remote scan. Arrays derived from a source (e.g. spatial indexes) are
+kept the same way.
+
+Each snapshot is a folder of one .npy file per column. Numeric, boolean, date
+and text columns (as fixed-width unicode) are memory-mapped on load; other
+objects (e.g. Shape tuples) are pickled.
+Snapshots are keyed by source, field list and where clause and are discarded
+when the source changes: files on disk (a FileGDB table's own files,
+shapefiles) are compared by modification time, everything else (SDE,
+in_memory, layers) by a row-count / max-OID probe.
+
+Describe and ListFields results are also kept, in memory, by MetadataCache.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import arcpy
+
+__all__ = ["SnapshotCache", "CACHE_DIR", "MetadataCache", "METADATA"]
+
+# Default location and size cap (bytes) of the snapshot cache
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "archacks_cache")
+CACHE_SIZE = 2 * 1024 ** 3
+
+
+def _varuint(data, pos):
+    """Reads a FileGDB variable-length unsigned int; returns it and the next
+    position.
+    """
+    value = shift = 0
+    while True:
+        byte = bytearray(data[pos:pos + 1])[0]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _gdb_table_files(gdb, name):
+    """Names of a FileGDB table's own files (a<id>.gdbtable, .gdbtablx,
+    .gdbindexes, .spx, ...), where <id> is the table's row in the system
+    catalog (a00000001.gdbtable). None if the catalog cannot be read or the
+    table is not in it.
+    """
+    try:
+        with open(os.path.join(gdb, "a00000001.gdbtablx"), "rb") as f:
+            index = f.read()
+        with open(os.path.join(gdb, "a00000001.gdbtable"), "rb") as f:
+            table = f.read()
+        rows, size = struct.unpack("<8x2i", index[:16])
+        for fid in range(1, rows + 1):
+            start = 16 + (fid - 1) * size
+            offset = struct.unpack(
+                "<Q", index[start:start + size] + b"\0" * (8 - size))[0]
+            if not offset:
+                # Deleted row
+                continue
+            # Rows are a 4-byte size, the Name (varuint length and UTF-8)
+            #  and FileFormat
+            length, pos = _varuint(table, offset + 4)
+            if table[pos:pos + length].decode("utf-8").lower() == \
+                    name.lower():
+                prefix = "a{:08x}.".format(fid)
+                return [f for f in os.listdir(gdb)
+                        if f.lower().startswith(prefix)
+                        and not f.lower().endswith(".lck")]
+    except (IOError, OSError, IndexError, struct.error, UnicodeDecodeError):
+        return None
+    return None
+
+
+def _source_mtime(source):
+    """Latest modification time of a source on disk, or None if not on disk.
+    FileGDB tables are checked through their own files only: lock files and
+    edits to other tables in the .gdb do not change it. If the table's files
+    cannot be found, None is returned (and the source is probed instead).
+    """
+    path = source.replace("\\", "/")
+    if ".gdb/" in path or path.endswith(".gdb"):
+        gdb = path[:path.index(".gdb") + 4]
+        if not os.path.isdir(gdb):
+            return None
+        name = path[len(gdb):].strip("/")
+        if name:
+            # Tables in feature datasets are cataloged by their own name
+            files = _gdb_table_files(gdb, name.split("/")[-1])
+            if not files:
+                return None
+        else:
+            files = [f for f in os.listdir(gdb)
+                     if not f.lower().endswith(".lck")]
+        return max([os.path.getmtime(os.path.join(gdb, f))
+                    for f in files] or [os.path.getmtime(gdb)])
+    if os.path.isfile(path):
+        base = os.path.splitext(path)[0]
+        folder = os.path.dirname(path) or "."
+        # Shapefiles are several files sharing a name
+        return max(os.path.getmtime(os.path.join(folder, f))
+                   for f in os.listdir(folder)
+                   if os.path.splitext(os.path.join(folder, f))[0] == base)
+    return None
+
+
+def _max_oid(source):
+    """Largest OID of a table; uses ORDER BY where the workspace allows it."""
+    oid_field = METADATA.describe(source).OIDFieldName
+    try:
+        sql = (None, "ORDER BY {} DESC".format(oid_field))
+        with arcpy.da.SearchCursor(source, ["OID@"], sql_clause=sql) as cur:
+            for row in cur:
+                return row[0]
+    except RuntimeError:
+        with arcpy.da.SearchCursor(source, ["OID@"]) as cur:
+            return max([row[0] for row in cur] or [None])
+    return None
+
+
+def source_stamp(source):
+    """A value that changes when the source data changes."""
+    mtime = _source_mtime(source)
+    if mtime is not None:
+        return ["mtime", mtime]
+    count = int(arcpy.GetCount_management(source).getOutput(0))
+    return ["probe", count, _max_oid(source)]
+
+
+def _save_column(folder, i, col):
+    """Saves a column; returns how it was stored ('npy', 'str' or 'pkl')."""
+    values = np.asarray(col)
+    if values.dtype != object:
+        np.save(os.path.join(folder, "{}.npy".format(i)), values)
+        return "npy"
+    nulls = np.asarray(pd.isnull(values))
+    if all(isinstance(v, (type(u""), str)) for v in values[~nulls]):
+        text = np.array([v if not n else u"" for v, n in zip(values, nulls)],
+                        dtype=type(u""))
+        np.save(os.path.join(folder, "{}.npy".format(i)), text)
+        np.save(os.path.join(folder, "{}.null.npy".format(i)), nulls)
+        return "str"
+    with open(os.path.join(folder, "{}.pkl".format(i)), "wb") as f:
+        pickle.dump(list(values), f, protocol=2)
+    return "pkl"
+
+
+def _load_column(folder, i, kind):
+    """Loads a column saved by _save_column (memory-mapped where possible)."""
+    if kind == "pkl":
+        with open(os.path.join(folder, "{}.pkl".format(i)), "rb") as f:
+            return pd.Series(pickle.load(f), dtype=object).values
+    path = os.path.join(folder, "{}.npy".format(i))
+    try:
+        values = np.load(path, mmap_mode="r")
+    except ValueError:
+        # Empty arrays cannot be memory-mapped
+        values = np.load(path)
+    if kind == "str":
+        nulls = np.load(os.path.join(folder, "{}.null.npy".format(i)))
+        if nulls.any():
+            values = values.astype(object)
+            values[nulls] = None
+    return values
+
+
+def _folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, f))
+               for f in os.listdir(folder))
+
+
+class SnapshotCache(object):
+    """Size-capped, least-recently-used cache of table snapshots on disk.
+    Args:
+        path (str): cache folder; created if missing
+        max_size (int): total size cap in bytes
+    Use:
+        >>> cache = SnapshotCache("C:/temp/archacks_cache", 500 * 1024 ** 2)
+        >>> df = tbl2df(owner_path, cache=cache)  # cold: scans, then stores
+        >>> df = tbl2df(owner_path, cache=cache)  # warm: memory-mapped
+    """
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self._index_path = os.path.join(self.path, "index.json")
+
+    @property
+    def index(self):
+        """{key: {"atime": last access, "size": bytes}} of stored snapshots."""
+        if not os.path.exists(self._index_path):
+            return {}
+        with open(self._index_path, "r") as f:
+            return json.load(f)
+
+    def _save_index(self, index):
+        with open(self._index_path, "w") as f:
+            json.dump(index, f)
+        return
+
+    @property
+    def size(self):
+        """Total size of all snapshots in bytes."""
+        return sum(v["size"] for v in self.index.values())
+
+    def key(self, source, fields, where=None, *extra):
+        """Hash of the source path, field list, where clause and extras."""
+        if os.path.exists(source):
+            source = os.path.abspath(source)
+        parts = [source, list(fields), where] + [str(e) for e in extra]
+        return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def _open(self, key, source):
+        """Folder and metadata of an up-to-date entry, or None."""
+        folder = os.path.join(self.path, key)
+        meta_path = os.path.join(folder, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta["stamp"] != source_stamp(source):
+            self.discard(key)
+            return None
+        index = self.index
+        if key in index:
+            index[key]["atime"] = time.time()
+            self._save_index(index)
+        return folder, meta
+
+    def _store(self, key, meta, write):
+        """Writes an entry through write(folder), which returns its kinds."""
+        meta["stamp"] = source_stamp(meta["source"])
+        tmp = tempfile.mkdtemp(dir=self.path)
+        meta["kinds"] = write(tmp)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        self.discard(key)
+        os.rename(tmp, os.path.join(self.path, key))
+        index = self.index
+        index[key] = {"atime": time.time(),
+                      "size": _folder_size(os.path.join(self.path, key))}
+        self._save_index(index)
+        self._evict()
+        return
+
+    def get(self, source, fields, where=None, *extra):
+        """Returns the cached dataframe, or None if missing or out of date."""
+        entry = self._open(self.key(source, fields, where, *extra), source)
+        if entry is None:
+            return None
+        folder, meta = entry
+        return pd.DataFrame(
+            dict((col, _load_column(folder, i, kind)) for i, (col, kind)
+                 in enumerate(zip(meta["columns"], meta["kinds"]))),
+            columns=meta["columns"])
+
+    def put(self, source, fields, where, df, *extra):
+        """Stores a dataframe as the snapshot of source/fields/where."""
+        def write(folder):
+            return [_save_column(folder, i, df[col])
+                    for i, col in enumerate(df.columns)]
+        meta = {"source": source, "fields": list(fields), "where": where,
+                "columns": list(df.columns)}
+        self._store(self.key(source, fields, where, *extra), meta, write)
+        return
+
+    def get_arrays(self, source, name, *extra):
+        """Returns a {name: memory-mapped array} dict stored by put_arrays,
+        or None if missing or out of date.
+        """
+        entry = self._open(self.key(source, [name], None, *extra), source)
+        if entry is None:
+            return None
+        folder, meta = entry
+        return dict((col, _load_column(folder, i, kind)) for i, (col, kind)
+                    in enumerate(zip(meta["columns"], meta["kinds"])))
+
+    def put_arrays(self, source, name, arrays, *extra):
+        """Stores a {name: array} dict (e.g. an index) derived from source."""
+        columns = sorted(arrays)
+        def write(folder):
+            return [_save_column(folder, i, arrays[col])
+                    for i, col in enumerate(columns)]
+        meta = {"source": source, "name": name, "columns": columns}
+        self._store(self.key(source, [name], None, *extra), meta, write)
+        return
+
+    def discard(self, key):
+        """Removes a snapshot by key."""
+        folder = os.path.join(self.path, key)
+        if os.path.exists(folder):
+            shutil.rmtree(folder, ignore_errors=True)
+        index = self.index
+        if key in index:
+            index.pop(key)
+            self._save_index(index)
+        return
+
+    def _evict(self):
+        """Drops least-recently-used snapshots until under max_size."""
+        index = self.index
+        total = sum(v["size"] for v in index.values())
+        for key in sorted(index, key=lambda k: index[k]["atime"]):
+            if total <= self.max_size:
+                break
+            total -= index[key]["size"]
+            self.discard(key)
+        return
+
+    def clear(self):
+        """Removes all snapshots."""
+        for key in list(self.index.keys()):
+            self.discard(key)
+        return
+
+
+def get_cache(cache):
+    """Resolves a `cache=` argument: True uses the default SnapshotCache."""
+    if cache is True:
+        return SnapshotCache()
+    return cache
+
+
+# =============================================================================
+# METADATA
+
+class MetadataCache(object):
+    """Describe and ListFields results kept in memory per catalog path.
+    ArcHacks' own writes (df2tbl, fc2fc, spatial_field_calc, add_field, join,
+    drop_join, drop_all, EZFieldMap, MemoryWorkspace, GDB/GDBPkg, ...) bump
+    the generation of the datasets they create, overwrite or change, which
+    drops their entries; a ttl also expires entries after that many seconds,
+    for changes made outside ArcHacks.
+    Args:
+        ttl (float): optional maximum age of an entry in seconds
+    Use:
+        >>> METADATA.describe(parcels).OIDFieldName  # miss: runs Describe
+        >>> METADATA.describe(parcels).fields        # hit
+        >>> METADATA.stats
+        {'hits': 1, 'misses': 1, 'entries': 1, 'generation': 0}
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        # Bumped on every change, so holders can tell if anything changed
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        # {catalog path: {(kind, args): (time, value)}}
+        self._entries = {}
+
+    def key(self, dataset):
+        """Catalog path of a dataset path, or None if it is not cached.
+        Bare names are not cached: arcpy resolves them to a layer or table
+        view (e.g. a joined layer in the TOC) before env.workspace, so a name
+        does not identify one dataset. Layer objects are not cached either.
+        """
+        if not isinstance(dataset, (str, type(u""))):
+            return None
+        dataset = dataset.replace("\\", "/")
+        if "/" not in dataset:
+            return None
+        return dataset.lower()
+
+    def _get(self, dataset, kind, args, build):
+        key = self.key(dataset)
+        if key is None:
+            return build()
+        entries = self._entries.setdefault(key, {})
+        entry = entries.get((kind, args))
+        if entry is not None and (
+                self.ttl is None or time.time() - entry[0] <= self.ttl):
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = build()
+        entries[(kind, args)] = (time.time(), value)
+        return value
+
+    def describe(self, dataset):
+        """Cached arcpy.Describe(dataset)."""
+        return self._get(dataset, "describe", (),
+                         lambda: arcpy.Describe(dataset))
+
+    def list_fields(self, dataset, wild_card=None, field_type=None):
+        """Cached arcpy.ListFields(dataset, wild_card, field_type)."""
+        def build():
+            return arcpy.ListFields(dataset, wild_card, field_type)
+        return self._get(dataset, "fields", (wild_card, field_type), build)
+
+    def bump(self, *datasets):
+        """Marks datasets (or, with none given, everything) as changed."""
+        self.generation += 1
+        if not datasets:
+            self._entries.clear()
+        for dataset in datasets:
+            key = self.key(dataset)
+            if key is None and isinstance(dataset, (str, type(u""))):
+                # A bare name may be the workspace dataset of that name
+                key = self.key(os.path.join(arcpy.env.workspace or "",
+                                            dataset))
+            self._entries.pop(key, None)
+        return
+
+    def clear(self):
+        """Drops all entries and resets the statistics."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    @property
+    def stats(self):
+        """Hits, misses, cached datasets and the current generation."""
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self._entries), "generation": self.generation}
+
+
+# The package-wide metadata cache
+METADATA = MetadataCache()
@@ -9,9 +9,14 @@ Object Oriented in-memory processing using arcpy.
 import os
 import re
 
+import pandas as pd
+
 import arcpy
 
-from archacks import tbl2df, is_active, TOC, refresh
+from archacks import (tbl2df, is_active, TOC, refresh, find_duplicates,
+                      spatial_index, read_geometry, related, select_by_ids,
+                      SelectionSet, IN_LIMITS)
+from _cache import source_stamp, METADATA
 
 __all__ = ["Env", "MemoryWorkspace", "EZFieldMap", "_SpatialRelations",
            "MemoryLayer"]#, "LayerObject"]
@@ -25,6 +30,24 @@ All tests pass in and outside of arcmap
 
 arcpy.env.overwriteOutput = True
 
+_text_types = (str, type(u""))
+
+
+class _lazy(object):
+    """Attribute built on first access and kept in the instance's __dict__
+    until it is deleted (see MemoryLayer._invalidate).
+    """
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.name] = self.func(obj)
+        return value
+
 
 class Env(object):
     """Environment object."""
@@ -185,7 +208,7 @@ class MemoryWorkspace(Env):
             out_name = prefix.format(rename)
         else:
             # Get feature's name via Describe
-            name = arcpy.Describe(fc).name
+            name = METADATA.describe(fc).name
             # Support SDE paths
             if len(re.findall("\.", name)) > 1 and not name.endswith(".shp"):
                 name = name.split(".")[-1]
@@ -195,6 +218,7 @@ class MemoryWorkspace(Env):
             out_name = prefix.format(name)
         arcpy.FeatureClassToFeatureClass_conversion(
             fc, self.path, out_name)
+        METADATA.bump(os.path.join(self.path, out_name))
         # Try to stylize new layer after the non-memory layer's symbology
         #if is_active() and fc in TOC.contents.keys():
         #    apply_symbology(out_name, fc_name, hide_old)
@@ -206,12 +230,13 @@ class MemoryWorkspace(Env):
         if rename:
             out_name = prefix.format(rename)
         else:
-            name = arcpy.Describe(tbl).name
+            name = METADATA.describe(tbl).name
             name = name.replace("$", "")
             if len(re.findall("\.", name)) > 1:
                 name = name.split(".")[-1]
             out_name = prefix.format(name)
         arcpy.TableToTable_conversion(tbl, "in_memory", out_name)
+        METADATA.bump(os.path.join("in_memory", out_name))
         return
 
     def remove(self, fc):
@@ -220,6 +245,7 @@ class MemoryWorkspace(Env):
         if os.path.dirname(fc) != "in_memory" or fc.startswith("mem_"):
             raise IOError("Must be in memory")
         arcpy.Delete_management(fc)
+        METADATA.bump(fc)
 
     def get_memorylayer(self, data):
         """Returns data in memory as a MemoryLayer object."""
@@ -230,15 +256,19 @@ class MemoryWorkspace(Env):
 class EZFieldMap(object):
     def __init__(self, parent):
         self.parent = parent
-        self._mapping = arcpy.FieldMappings()
-        self._mapping.addTable(self.parent.source)
+        # Built from the parent's schema on first use
         self._str = ""
-        # Ensure it is ready to go
-        self.as_str
+
+    @_lazy
+    def _mapping(self):
+        mapping = arcpy.FieldMappings()
+        mapping.addTable(self.parent.source)
+        return mapping
 
     def reset(self):
         """Undo staged changes to field map."""
-        self.__init__(self.parent)
+        self.__dict__.pop("_mapping", None)
+        self._str = ""
         return
 
     @property
@@ -323,7 +353,7 @@ class EZFieldMap(object):
         regex_name = re.sub("\$\.", "\\$\\.", field_name)
         regex_name = re.sub("\$_", "\\$_", regex_name)
         regex = "{}(?!,)".format(regex_name)
-        self._str = re.sub(regex, new_name, self._str)
+        self._str = re.sub(regex, new_name, self.as_str)
         return
 
     def rename_by_split(self, split_seq, case=''):
@@ -369,10 +399,11 @@ class EZFieldMap(object):
             tmp_name, "in_memory", self.parent.name)
         # Remove temp
         arcpy.Delete_management(tmp_name)
+        METADATA.bump(self.parent.source)
         # Relink the parent object with the new data
-        self.parent.__init__(self.parent.name)
-        # Re-init the field map
-        self.__init__(self.parent)
+        self.parent._invalidate("_lyr", "selection")
+        # Re-read the field map
+        self.reset()
         return
 
     def export(self, out_name, out_loc="in_memory"):
@@ -380,10 +411,34 @@ class EZFieldMap(object):
         arcpy.FeatureClassToFeatureClass_conversion(
             self.parent._lyr, out_loc, out_name,
             field_mapping=self.as_str)
+        METADATA.bump(os.path.join(out_loc, out_name))
         return
 
     def __str__(self):
-        return self._str
+        return self.as_str
+
+
+# Relationships _SpatialRelations evaluates in-process, on the layers' cached
+#  geometry, rather than with SelectLayerByLocation_management
+IN_PROCESS = ("INTERSECT", "WITHIN", "CONTAINS", "WITHIN_A_DISTANCE",
+              "HAVE_THEIR_CENTER_IN", "BOUNDARY_TOUCHES")
+
+
+def _selected_geometry(features):
+    """Geometry of a MemoryLayer's (or a layer's) selected features, or of
+    all of them if nothing is selected.
+    """
+    if not isinstance(features, MemoryLayer):
+        return read_geometry(features)
+    geometry = features.geometry
+    try:
+        oids = features._lyr.getSelectionSet()
+    except AttributeError:
+        oids = None
+    if not oids:
+        return geometry
+    positions = pd.Index(geometry.oids).get_indexer(list(oids))
+    return geometry.take(positions[positions >= 0])
 
 
 # TODO: these selections only work on the <obj>.lyr object not what's visible in ArcMap
@@ -410,48 +465,84 @@ class _SpatialRelations(object):
         CLOSEST_GEODESIC - Same as CLOSEST except that geodesic distance is used rather than planar distance. Choose this if your data covers a large geographic extent or the coordinate system of the inputs is unsuitable for distance calculations.
         """
 
+    # Parsed from __doc__ once, by the first instance
+    definitions = {}
+    all = []
+    _methods = {}
+
     def __init__(self, parent):
         self.parent = parent
-        self.all = []
-        self.definitions = {}
+        # {name: SelectionSet} of saved selections
+        self.saved = {}
         self._set_defs()
-        self._set_attrs()
 
-    def _set_defs(self):
-        self.definitions = {
+    @classmethod
+    def _set_defs(cls):
+        if cls.definitions:
+            return
+        cls.definitions = {
             pair[0].strip(): pair[1].strip() for pair in
-                [line.split(" - ") for line in self.__doc__.split("\n")]
+                [line.split(" - ") for line in cls.__doc__.split("\n")]
             if pair[0].strip()}
+        cls.all = sorted(cls.definitions)
+        cls._methods = {k.title(): k for k in cls.definitions}
 
     def _select_by_loc(self, sel_type):
-        def select(select_features, search_distance=""):
-            arcpy.SelectLayerByLocation_management(
-                self.parent._lyr, sel_type,
-                select_features._lyr, search_distance)
+        def select(select_features, search_distance="",
+                   selection_type="NEW_SELECTION"):
+            try:
+                distance = float(search_distance or 0)
+            except ValueError:
+                # Distances with units (e.g. '50 Feet') are left to arcpy
+                distance = None
+            if sel_type in IN_PROCESS and distance is not None:
+                parent = self.parent
+                # One stamp for both
+                stamp = parent._shape_stamp()
+                geometry = parent._derive("geometry", read_geometry, stamp)
+                tree = parent._derive("index", spatial_index, stamp)
+                tree = tree.for_oids(geometry.oids)
+                found = related(geometry, _selected_geometry(select_features),
+                                sel_type, distance, tree)
+                oids = geometry.oids[found].tolist()
+                # Small results go in one IN list, so one call applies them
+                runs = {"min_run": len(oids) + 1} \
+                    if len(oids) <= IN_LIMITS["default"] else {}
+                select_by_ids(parent._lyr, "OID@", oids, selection_type,
+                              **runs)
+            else:
+                arcpy.SelectLayerByLocation_management(
+                    self.parent._lyr, sel_type,
+                    getattr(select_features, "_lyr", select_features),
+                    search_distance, selection_type)
             return self.parent._lyr  # TODO: untested
         return select
 
-    def _set_attrs(self):
-        for k in self.definitions.keys():
-            self.all.append(k)
-            setattr(self, k.title(), self._select_by_loc(k))
-        self.all.sort()
+    def __getattr__(self, attr):
+        # Selection methods (e.g. .Intersect) are built on first use
+        sel_type = self._methods.get(attr)
+        if sel_type is None:
+            raise AttributeError(attr)
+        method = self._select_by_loc(sel_type)
+        setattr(self, attr, method)
+        return method
 
     # TODO: selected attrs dataframe
 
     def where(self, qry):
+        """Selects the features matching a query, within the current
+        selection if there is one.
+        """
         sel_method = "NEW_SELECTION"
-        if self.parent._lyr.getSelectionSet():
+        if self.count:
             sel_method = "SUBSET_SELECTION"
         arcpy.SelectLayerByAttribute_management(
             self.parent._lyr, sel_method, qry)  # Changed from .name
         return self.parent._lyr
 
     def switch(self):
-        """Switches/inverts the current selection."""
-        arcpy.SelectLayerByAttribute_management(
-            self.parent.name, "SWITCH_SELECTION")
-        return self.parent._lyr
+        """Switches/inverts the current selection (in memory, see apply)."""
+        return self.apply(~self.current)
 
     def clear(self):
         """Clears/deselects the current selection."""
@@ -459,39 +550,106 @@ class _SpatialRelations(object):
             self.parent._lyr, "CLEAR_SELECTION")
         return
 
+    def _selected(self):
+        """The OIDs selected on the layer (empty if there are none)."""
+        try:
+            return self.parent._lyr.getSelectionSet() or ()
+        except AttributeError:
+            return ()
+
     @property
     def count(self):
         """Returns the number of selected features."""
-        try:
-            return len(self.parent._lyr.getSelectionSet())
-        except TypeError:
-            return 0
+        return len(self._selected())
+
+    @property
+    def current(self):
+        """The layer's current selection as a SelectionSet (its universe is
+        all of the layer's OIDs, so it can be inverted with ~).
+        """
+        return SelectionSet(self._selected(), universe=self.parent.oids)
+
+    def save(self, name, selection=None):
+        """Saves the current selection (or a SelectionSet) under a name and
+        returns it. Saved selections are combined in memory.
+        Example:
+            >>> sel = parcels.selection
+            >>> sel.Intersect(floodplain); sel.save("flood")
+            >>> sel.where("Zoning = 'R1'"); sel.save("r1")
+            >>> sel.apply(sel["flood"] & ~sel["r1"])
+        """
+        if selection is None:
+            selection = self.current
+        self.saved[name] = selection
+        return selection
+
+    def __getitem__(self, name):
+        return self.saved[name]
+
+    def apply(self, selection, selection_type="NEW_SELECTION"):
+        """Selects a SelectionSet's (or a saved selection's) OIDs on the
+        layer; nothing is done if it is already the layer's selection.
+        Args:
+            selection (SelectionSet/str): the OIDs, or the name of a saved
+                selection
+            selection_type (str): as SelectLayerByAttribute_management
+        """
+        if not isinstance(selection, SelectionSet):
+            selection = self.saved[selection]
+        # Only applied if it changes the layer's selection
+        if selection_type != "NEW_SELECTION" or \
+                selection != SelectionSet(self._selected()):
+            select_by_ids(self.parent._lyr, "OID@", selection.tolist(),
+                          selection_type)
+        return self.parent._lyr
 
 
 class MemoryLayer(object):
     """Object-oriented in-memory data layer."""
     def __init__(self, data):
-        desc = arcpy.Describe(data)
-        self.source = desc.catalogPath
+        # In-memory paths need no Describe; the layer, field map and
+        #  selections are built on first use (see _invalidate)
+        if isinstance(data, _text_types) and \
+                os.path.dirname(data) == "in_memory":
+            self.source = data
+        else:
+            self.source = arcpy.Describe(data).catalogPath
         if os.path.dirname(self.source) != "in_memory":
             raise IOError("Data is not in memory.")
-        self.name = desc.name
-        # Set the layer property to that in ArcMap's TOC if open
-        if is_active():
-            self._lyr = TOC[self.name]
-        else:
-            self._lyr = arcpy._mapping.Layer(data)
-        self.fmap = EZFieldMap(self)
-        self.selection = _SpatialRelations(self)
+        self.name = os.path.basename(self.source)
         self._joins = {}
+        # {name: (source stamp, value)} of data derived from the features
+        self._derived = {}
+
+    @_lazy
+    def _lyr(self):
+        # The layer in ArcMap's TOC if open
+        if is_active():
+            return TOC[self.name]
+        return arcpy._mapping.Layer(self.source)
+
+    @_lazy
+    def fmap(self):
+        return EZFieldMap(self)
+
+    @_lazy
+    def selection(self):
+        return _SpatialRelations(self)
+
+    def _invalidate(self, *names):
+        """Drops lazily built attributes (e.g. 'fmap' after a schema change)
+        so they are rebuilt on next use.
+        """
+        for name in names:
+            self.__dict__.pop(name, None)
 
     @property
     def desc(self):
-        return arcpy.Describe(self.source)
+        return METADATA.describe(self.source)
 
     @property
     def fields(self):
-        return {f.name: f for f in arcpy.Describe(self.source).fields}
+        return {f.name: f for f in self.desc.fields}
 
     @property
     def field_names(self):
@@ -527,6 +685,8 @@ class MemoryLayer(object):
         try:
             arcpy.AddField_management(
                 self.name, f_name, f_type, "", "", f_len, alias)
+            self._invalidate("fmap")
+            METADATA.bump(self.source)
             if calc:
                 arcpy.CalculateField_management(
                     self.name, f_name, calc, "PYTHON", code_blk)
@@ -535,6 +695,7 @@ class MemoryLayer(object):
             # If an error with the calculation occurs, delete the created field
             if f_name in self.fields:
                 arcpy.DeleteField_management(self.name, f_name)
+                METADATA.bump(self.source)
             raise e
         return
 
@@ -542,6 +703,8 @@ class MemoryLayer(object):
         """Add and calculate a new area field (FLOAT)."""
         try:
             arcpy.AddField_management(self.name, field, "FLOAT")
+            self._invalidate("fmap")
+            METADATA.bump(self.source)
         except:
             pass
         calc = "!shape.area@{}!".format(unit)
@@ -551,25 +714,80 @@ class MemoryLayer(object):
             raise AttributeError("Unknown areal unit: {}".format(unit))
         return
 
+    def _derive(self, name, build, stamp=None):
+        """build(source), kept until stamp (default: source_stamp) changes."""
+        if stamp is None:
+            stamp = source_stamp(self.source)
+        if name not in self._derived or self._derived[name][0] != stamp:
+            self._derived[name] = (stamp, build(self.source))
+        return self._derived[name][1]
+
+    def _shape_stamp(self):
+        """source_stamp plus METADATA's generation. For in_memory data the
+        stamp only probes the row count and max OID, so shapes edited in
+        place are picked up after an ArcHacks write (or METADATA.bump).
+        """
+        return source_stamp(self.source) + [METADATA.generation]
+
+    @property
+    def index(self):
+        """Packed R-tree of the features' bounding boxes (with OIDs); rebuilt
+        only when the data has changed (see _shape_stamp).
+        """
+        return self._derive("index", spatial_index, self._shape_stamp())
+
+    @property
+    def geometry(self):
+        """All features' shapes as a GeometryArray; read again only when the
+        data has changed (see _shape_stamp).
+        """
+        return self._derive("geometry", read_geometry, self._shape_stamp())
+
+    @property
+    def oids(self):
+        """All of the features' OIDs as a SelectionSet; read again only when
+        the data has changed.
+        """
+        def read(source):
+            with arcpy.da.SearchCursor(source, "OID@") as cur:
+                return SelectionSet(row[0] for row in cur)
+        return self._derive("oids", read)
+
+    def oids_in(self, bbox, distance=0):
+        """Sorted OIDs of the features whose bounding boxes intersect bbox
+        (xmin, ymin, xmax, ymax), grown by distance.
+        """
+        return self.index.query_oids(bbox, distance).tolist()
+
     @property
     def joins(self):
         return self._joins
 
-    def join(self, tbl, pkey, fkey):
-        """Joins the current data with a table."""
-        # Create a temp backup of joins dict; re-init-ing kills the old one
-        current_joins = self.joins.copy()
+    def join(self, tbl, pkey, fkey, check_keys=False):
+        """Joins the current data with a table.
+        Args:
+            tbl (str): path of the table to join
+            pkey (str): key field of the current data
+            fkey (str): key field of tbl
+            check_keys (bool): raise a ValueError if fkey values are not
+                unique in tbl (only the first match would be joined)
+        """
+        if check_keys:
+            dups = find_duplicates(tbl, fkey)
+            if dups:
+                raise ValueError("{} duplicate value(s) in {}: {}".format(
+                    len(dups), fkey, sorted(dups)[:10]))
         # Get table info
-        tbl_desc = arcpy.Describe(tbl)
+        tbl_desc = METADATA.describe(tbl)
         tbl_name = tbl_desc.name
         tbl_fields = [f.name for f in tbl_desc.fields]
         # Join
         arcpy.JoinField_management(self.name, pkey, tbl, fkey)
-        # Re-init the current object
-        self.__init__(self.name)
+        # The schema changed: only the field map needs rebuilding
+        self._invalidate("fmap")
+        METADATA.bump(self.source)
         # Update the joins dict
-        current_joins.update({tbl_name: tbl_fields})
-        self._joins = current_joins
+        self._joins[tbl_name] = tbl_fields
         return
         # TODO: spatial join with specified field to keep rather than all
 
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+_matching.py -- Batched Text Matching
+Author: Garin Wally
+License: MIT
+
+Matches sets of patterns against whole batches of values (e.g. a chunk of a
+cursor) instead of value by value. Patterns are compiled once; each distinct
+value in a batch is tested once and the result broadcast back to its rows.
+Large sets of plain substrings use an Aho-Corasick automaton, which finds all
+of them in a single pass over each value.
+"""
+
+import re
+from collections import OrderedDict, deque
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["PatternSet", "AhoCorasick"]
+
+_text_types = (str, type(u""))
+
+
+def _distinct_text(values):
+    """Factorizes values: (row codes, distinct values as text). NULLs get -1."""
+    codes, uniques = pd.factorize(pd.Series(list(values), dtype=object))
+    uniques = pd.Series(
+        [v if isinstance(v, _text_types) else str(v) for v in uniques],
+        dtype=object)
+    return np.asarray(codes), uniques
+
+
+def _broadcast(codes, hits):
+    """Maps per-distinct-value results back to rows (NULL rows are False)."""
+    mask = np.zeros(len(codes), dtype=bool)
+    valid = codes >= 0
+    mask[valid] = np.asarray(hits, dtype=bool)[codes[valid]]
+    return mask
+
+
+class PatternSet(object):
+    """Named regular expressions, compiled once, searched for (as re.search
+    does) in batches of values.
+    Args:
+        patterns (dict/list/str): {name: pattern}, a list of patterns (named
+            by themselves) or a single pattern; compiled patterns are kept
+        flags (int): re flags used to compile string patterns
+    Example:
+        >>> ps = PatternSet({"po_box": r"(?i)\bP\.?O\.? BOX", "unit": r"#\d+"})
+        >>> ps.match([u"PO Box 12", u"100 Main St #4", None])
+        OrderedDict([('po_box', array([ True, False, False])),
+                     ('unit', array([False,  True, False]))])
+    """
+    def __init__(self, patterns, flags=0):
+        if isinstance(patterns, dict):
+            items = list(patterns.items())
+        elif isinstance(patterns, (list, tuple)):
+            items = [(p, p) for p in patterns]
+        else:
+            items = [(patterns, patterns)]
+        self.patterns = OrderedDict(
+            (name, p if hasattr(p, "search") else re.compile(p, flags))
+            for name, p in items)
+
+    @property
+    def names(self):
+        return list(self.patterns.keys())
+
+    def match(self, values):
+        """Returns {name: boolean array} of the values each pattern is found
+        in; NULLs never match.
+        """
+        codes, uniques = _distinct_text(values)
+        return OrderedDict(
+            (name, _broadcast(codes, uniques.str.contains(regex)))
+            for name, regex in self.patterns.items())
+
+
+class AhoCorasick(object):
+    """Automaton finding any number of substrings in one pass over a text.
+    Args:
+        words (iterable): substrings to find (matched case-sensitively)
+    Example:
+        >>> ac = AhoCorasick(["RANCH", "APPLE"])
+        >>> ac.find(u"APPLE RANCH ESTATES")
+        set([0, 1])
+    """
+    def __init__(self, words):
+        self.words = list(words)
+        goto = [{}]
+        out = [set()]
+        for i, word in enumerate(self.words):
+            node = 0
+            for ch in word:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    out.append(set())
+                node = nxt
+            out[node].add(i)
+        # Failure links (longest proper suffix that is also a prefix), by BFS
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                queue.append(nxt)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] |= out[fail[nxt]]
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+
+    def __len__(self):
+        return len(self.words)
+
+    def search(self, text):
+        """True if any of the words is in text."""
+        goto, fail, out = self._goto, self._fail, self._out
+        if out[0]:
+            # The empty string
+            return True
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                return True
+        return False
+
+    def find(self, text):
+        """Indexes of the words found in text."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set(out[0])
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found |= out[node]
+        return found
+
+    def match(self, values, condition="OR"):
+        """Returns a boolean array of the values containing any ('OR') or all
+        ('AND') of the words; NULLs never match.
+        """
+        codes, uniques = _distinct_text(values)
+        if condition.upper() == "AND":
+            hits = [len(self.find(v)) == len(self.words) for v in uniques]
+        else:
+            hits = [self.search(v) for v in uniques]
+        return _broadcast(codes, hits)
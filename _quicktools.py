@@ -488,18 +488,10 @@ class ExportNeighborsToExcel(object):
             where_clause=("County4.dbo.ParcelTable.Owner IS NULL AND "
                           "County4.dbo.ParcelTable.StateGeo IS NULL"))
 
-        # Get record information from selected parcels as DataFrame
-        frames = []
-        with arcpy.da.SearchCursor("City Parcels", fields) as cur:
-            for row in cur:
-                row_df = pd.DataFrame(list(row)).T
-                row_df.columns = fnames
-                frames.append(row_df)
-        df = pd.concat(frames)
-
-        # Export dataframe as Excel
-        #debug.write(str(df))
-        df.to_excel(out_file, index=False)
+        # Stream the selected parcels' records into Excel
+        aliases = [n or f for f, n in zip(fields, fnames)]
+        with archacks.ExcelStream(out_file) as xl:
+            xl.add_sheet("City Parcels", fields, aliases, name="Neighbors")
 
         #debug.close()
         return
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+_sampling.py -- Random Samples of Tables
+Author: Garin Wally
+License: MIT
+
+Single-pass samples of rows, OIDs or distinct values, optionally stratified.
+Each candidate gets a random key and the rows with the k smallest keys are
+kept (a bottom-k reservoir), so memory is bounded by the sample size plus one
+chunk and a seed reproduces the same sample. Distinct values are keyed by a
+seeded hash of the value, so repeats of a value never need to be tracked.
+"""
+
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+import arcpy
+
+from _cache import METADATA
+from _core import CHUNKSIZE, _as_list, select_by_ids
+
+__all__ = ["sample", "sample_oids", "select_random"]
+
+
+def _hash_keys(values, seed):
+    """Seeded pseudo-random keys in [0, 1), equal for equal values."""
+    hashes = pd.util.hash_array(np.asarray(list(values), dtype=object),
+                                hash_key="{:016d}".format(seed)[-16:])
+    return hashes / float(2 ** 64)
+
+
+def _keep(pool, size, by):
+    """Rows of pool (sorted by key) within each stratum's sample size."""
+    if by is None:
+        return pool.iloc[:size]
+    rank = pool.groupby(by, sort=False).cumcount().values
+    if isinstance(size, dict):
+        limit = pool[by].map(size).fillna(0).values
+    else:
+        limit = size
+    return pool[rank < limit]
+
+
+def sample(fc, size, fields=None, by=None, where=None, seed=None,
+           distinct=False, filter_func=None, chunksize=CHUNKSIZE):
+    """Random sample of a table's rows (or distinct values) in a single cursor
+    pass.
+    Args:
+        fc (str): name or path of input table or feature class
+        size (int/dict): sample size; with `by`, the size of every stratum or
+            a {group value: size} dict (unlisted groups are not sampled)
+        fields (list): fields to return with the OID
+        by (str): optional field to stratify by
+        where (str): optional where clause applied by the cursor
+        seed (int): seed for a reproducible sample
+        distinct (bool): sample distinct values of fields[0] instead of rows
+            (the first row of each sampled value is returned)
+        filter_func (function): only rows whose fields[0] value it returns
+            True for are sampled
+        chunksize (int): rows read at a time
+    Returns a dataframe of the sampled rows in OID order. If there are fewer
+    candidates than size, all of them are returned.
+    Example:
+        >>> # 50 parcels per ward for a QA audit, reproducibly
+        >>> sample(parcels, 50, ["ParcelID", "Owner"], by="Ward", seed=2017)
+    """
+    fields = _as_list(fields) if fields else []
+    if (distinct or filter_func) and not fields:
+        raise ValueError("distinct and filter_func need a field")
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31 - 1)
+    rng = np.random.RandomState(seed)
+    oid_field = METADATA.describe(fc).OIDFieldName
+    columns = [oid_field] + [f for f in fields if f != oid_field]
+    if by and by not in columns:
+        columns.append(by)
+    cursor_fields = ["OID@"] + columns[1:]
+    index = columns.index(fields[0]) if fields else None
+    kept = pd.DataFrame(columns=columns + ["_key"])
+    with arcpy.da.SearchCursor(fc, cursor_fields, where) as cur:
+        rows = list(islice(cur, chunksize))
+        while rows:
+            if filter_func:
+                rows = [row for row in rows if filter_func(row[index])]
+            chunk = pd.DataFrame.from_records(rows, columns=columns)
+            if distinct:
+                chunk["_key"] = _hash_keys(chunk[fields[0]], seed)
+            else:
+                chunk["_key"] = rng.random_sample(len(chunk))
+            pool = pd.concat([kept, chunk]) if len(kept) else chunk
+            if distinct:
+                pool = pool.drop_duplicates(
+                    [fields[0]] + ([by] if by else []))
+            pool = pool.sort_values("_key", kind="mergesort")
+            kept = _keep(pool, size, by)
+            rows = list(islice(cur, chunksize))
+    kept = kept.sort_values(oid_field).drop("_key", axis=1)
+    return kept.reset_index(drop=True)
+
+
+def sample_oids(fc, size, by=None, where=None, seed=None,
+                chunksize=CHUNKSIZE):
+    """Returns a sorted list of randomly sampled OIDs (see sample)."""
+    df = sample(fc, size, by=by, where=where, seed=seed, chunksize=chunksize)
+    return df.iloc[:, 0].astype(int).tolist()
+
+
+def select_random(layer, field, sample_size, filter_lambda=None, by=None,
+                  seed=None, oids=False, selection_type="NEW_SELECTION"):
+    """Selects a random number of features from a layer.
+    Args:
+        layer (str): name of a layer in the TOC
+        field (str): name of a field/attribute in the layer
+        sample_size (int/dict): number of random distinct field values to
+            select (per stratum when `by` is used; see sample)
+        filter_lambda (function): optionally filter the values using a
+            function
+        by (str): optional field to stratify by
+        seed (int): seed for a reproducible selection
+        oids (bool): sample features (by OID) rather than field values
+        selection_type (str): as SelectLayerByAttribute_management
+    Returns the sampled values (or OIDs).
+    Example:
+        # Select 10 random parcels that do not have a "7" at position -4
+        #  in the 'ParcelID' field
+        >>> select_random("Parcels", "ParcelID", 10, lambda x: x[-4] <> "7")
+    """
+    if oids:
+        df = sample(layer, sample_size, [field], by, seed=seed,
+                    filter_func=filter_lambda)
+        ids = df.iloc[:, 0].astype(int).tolist()
+        select_by_ids(layer, "OID@", ids, selection_type)
+        return ids
+    df = sample(layer, sample_size, [field], by, seed=seed, distinct=True,
+                filter_func=filter_lambda)
+    values = df[field].tolist()
+    select_by_ids(layer, arcpy.AddFieldDelimiters(layer, field), values,
+                  selection_type)
+    return values
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+_selection.py -- Compressed Selection Sets
+Author: Garin Wally
+License: MIT
+
+Sets of OIDs stored as compressed bitmaps, so selections can be saved,
+combined and inverted in memory and only applied to a layer when needed.
+As in a roaring bitmap, OIDs are split into chunks of 65536 by their high
+bits; each chunk holds either a sorted array of its low 16 bits (when sparse)
+or a packed 8 KB bitmap (when dense), and set operations work chunk by chunk.
+"""
+
+import numpy as np
+
+__all__ = ["SelectionSet"]
+
+CHUNK = 1 << 16
+# Chunks with more members than this are stored as bitmaps
+ARRAY_MAX = 4096
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+_EMPTY = np.zeros(0, dtype=np.uint16)
+
+
+# =============================================================================
+# CONTAINERS
+# A container is either a sorted uint16 array of members or a packed uint8
+#  bitmap of CHUNK bits
+
+def _is_bitmap(container):
+    return container.dtype == np.uint8
+
+
+def _to_bitmap(container):
+    if _is_bitmap(container):
+        return container
+    bits = np.zeros(CHUNK, dtype=bool)
+    bits[container] = True
+    return np.packbits(bits)
+
+
+def _to_array(container):
+    if not _is_bitmap(container):
+        return container
+    return np.flatnonzero(np.unpackbits(container)).astype(np.uint16)
+
+
+def _cardinality(container):
+    if _is_bitmap(container):
+        return int(_POPCOUNT[container].sum())
+    return len(container)
+
+
+def _compact(container):
+    """The container in its smaller form, or None if it is empty."""
+    count = _cardinality(container)
+    if not count:
+        return None
+    if _is_bitmap(container) and count <= ARRAY_MAX:
+        return _to_array(container)
+    if not _is_bitmap(container) and count > ARRAY_MAX:
+        return _to_bitmap(container)
+    return container
+
+
+def _has(bitmap, low):
+    """Boolean array: are the low values set in the bitmap?"""
+    low = low.astype(np.int64)
+    return ((bitmap[low >> 3] >> (7 - (low & 7))) & 1).astype(bool)
+
+
+def _and(a, b):
+    if _is_bitmap(a) and _is_bitmap(b):
+        return _compact(a & b)
+    if _is_bitmap(a):
+        a, b = b, a
+    if _is_bitmap(b):
+        return _compact(a[_has(b, a)])
+    return _compact(np.intersect1d(a, b, assume_unique=True))
+
+
+def _or(a, b):
+    if _is_bitmap(a) or _is_bitmap(b):
+        return _compact(_to_bitmap(a) | _to_bitmap(b))
+    return _compact(np.union1d(a, b).astype(np.uint16))
+
+
+def _xor(a, b):
+    if _is_bitmap(a) or _is_bitmap(b):
+        return _compact(_to_bitmap(a) ^ _to_bitmap(b))
+    return _compact(np.setxor1d(a, b, assume_unique=True).astype(np.uint16))
+
+
+def _sub(a, b):
+    if _is_bitmap(b):
+        if _is_bitmap(a):
+            return _compact(a & ~b)
+        return _compact(a[~_has(b, a)])
+    if _is_bitmap(a):
+        return _compact(a & ~_to_bitmap(b))
+    return _compact(np.setdiff1d(a, b, assume_unique=True).astype(np.uint16))
+
+
+# =============================================================================
+# SELECTION SETS
+
+class SelectionSet(object):
+    """A set of OIDs held as a compressed bitmap.
+    Args:
+        oids (iterable): OIDs in the set (non-negative integers)
+        universe (SelectionSet/iterable): optional set of all the layer's
+            OIDs, needed to invert (~) a selection
+    Supports & (and), | (or), ^ (xor), - (difference) and ~ (not, within the
+    universe), len(), `in` and iteration in OID order.
+    Example:
+        >>> downtown = SelectionSet([3, 4, 5, 70000], universe=range(100000))
+        >>> vacant = SelectionSet(range(0, 100000, 2))
+        >>> len(downtown & vacant), len(~downtown)
+        (2, 99996)
+    """
+    def __init__(self, oids=(), universe=None):
+        self._chunks = {}
+        if universe is not None and not isinstance(universe, SelectionSet):
+            universe = SelectionSet(universe)
+        self.universe = universe
+        oids = np.unique(np.asarray(list(oids) if not hasattr(oids, "dtype")
+                                    else oids, dtype=np.int64))
+        if len(oids) and oids[0] < 0:
+            raise ValueError("OIDs must not be negative")
+        keys = oids >> 16
+        low = (oids & (CHUNK - 1)).astype(np.uint16)
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        starts = np.concatenate([[0], bounds]).astype(np.int64)
+        ends = np.concatenate([bounds, [len(oids)]]).astype(np.int64)
+        for start, end in zip(starts, ends):
+            if end > start:
+                self._chunks[int(keys[start])] = _compact(low[start:end])
+
+    @classmethod
+    def _from_chunks(cls, chunks, universe):
+        new = cls(universe=universe)
+        new._chunks = chunks
+        return new
+
+    def _combine(self, other, op, keys):
+        if not isinstance(other, SelectionSet):
+            other = SelectionSet(other)
+        chunks = {}
+        for key in keys(set(self._chunks), set(other._chunks)):
+            a = self._chunks.get(key, _EMPTY)
+            b = other._chunks.get(key, _EMPTY)
+            container = op(a, b)
+            if container is not None:
+                chunks[key] = container
+        universe = self.universe if self.universe is not None \
+            else other.universe
+        return SelectionSet._from_chunks(chunks, universe)
+
+    def __and__(self, other):
+        return self._combine(other, _and, lambda a, b: a & b)
+
+    def __or__(self, other):
+        return self._combine(other, _or, lambda a, b: a | b)
+
+    def __xor__(self, other):
+        return self._combine(other, _xor, lambda a, b: a | b)
+
+    def __sub__(self, other):
+        return self._combine(other, _sub, lambda a, b: a)
+
+    __rand__ = __and__
+    __ror__ = __or__
+    __rxor__ = __xor__
+
+    def __rsub__(self, other):
+        return SelectionSet(other, self.universe) - self
+
+    def __invert__(self):
+        if self.universe is None:
+            raise ValueError("Inverting a selection needs its universe")
+        return self.universe - self
+
+    def __len__(self):
+        return sum(_cardinality(c) for c in self._chunks.values())
+
+    def __bool__(self):
+        return bool(self._chunks)
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, oid):
+        try:
+            oid = int(oid)
+        except (TypeError, ValueError):
+            return False
+        container = self._chunks.get(oid >> 16)
+        if container is None:
+            return False
+        low = oid & (CHUNK - 1)
+        if _is_bitmap(container):
+            return bool(_has(container, np.array([low]))[0])
+        i = np.searchsorted(container, low)
+        return i < len(container) and container[i] == low
+
+    def __iter__(self):
+        for key in sorted(self._chunks):
+            for low in _to_array(self._chunks[key]).tolist():
+                yield (key << 16) | low
+
+    def __eq__(self, other):
+        if not isinstance(other, SelectionSet):
+            return NotImplemented
+        if sorted(self._chunks) != sorted(other._chunks):
+            return False
+        return all(np.array_equal(_to_array(c), _to_array(other._chunks[k]))
+                   for k, c in self._chunks.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<SelectionSet: {} OIDs>".format(len(self))
+
+    def to_array(self):
+        """Returns the OIDs as a sorted int64 array."""
+        if not self._chunks:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([
+            (np.int64(key) << 16) | _to_array(self._chunks[key]).astype(
+                np.int64) for key in sorted(self._chunks)])
+
+    def tolist(self):
+        """Returns the OIDs as a sorted list."""
+        return self.to_array().tolist()
+
+    @property
+    def nbytes(self):
+        """Bytes used by the chunk containers."""
+        return sum(c.nbytes for c in self._chunks.values())
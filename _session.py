@@ -12,8 +12,13 @@ import os
 import re
 
 import arcpy
-import pythonaddins
+try:
+    import pythonaddins
+except ImportError:
+    # Only available inside ArcMap
+    pythonaddins = None
 
+from _cache import METADATA
 from _core import fc2fc, TOC, is_active, MXD
 
 
@@ -107,6 +112,7 @@ def join_all(fc, uid, to_field=None):
                       if f.name != uid]
             try:
                 arcpy.JoinField_management(fc, uid, tbl, to_field, fields)
+                METADATA.bump(fc)
             except:
                 warnings.append(tbl.name)
         if warnings:
@@ -154,6 +160,7 @@ class MemoryWorkspace(object):
                 name = name.split(".")[-1]
             out_name = prefix.format(name)
         arcpy.TableToTable_conversion(tbl, "in_memory", out_name)
+        METADATA.bump(os.path.join("in_memory", out_name))
         return
 
     def remove(self, fc):
@@ -174,6 +181,7 @@ class MemoryWorkspace(object):
                       if f.name != uid]
             try:
                 arcpy.JoinField_management(fc, uid, tbl, to_field, fields)
+                METADATA.bump(fc)
             except:
                 warnings.append(tbl.name)
         if warnings:
@@ -0,0 +1,1325 @@
+# -*- coding: utf-8 -*-
+"""
+_spatial.py -- In-process Spatial Relationships
+Author: Garin Wally
+License: MIT
+
+Spatial joins without a geoprocessing round trip. Geometries are read once
+into flat NumPy arrays (vertices, part and geometry offsets, bounding boxes),
+candidate pairs come from a packed R-tree over the bounding boxes, and the
+relationship is then tested for all candidate pairs at once, a batch of
+segment pairs at a time. R-trees can be kept in a SnapshotCache, so static
+layers are only indexed again when they change. Nearest neighbours come from
+a k-d tree queried for whole batches of points.
+
+Relationships are planar and tested on the vertices as stored (no curves,
+Z/M values or projections). Coordinates closer than TOLERANCE are treated as
+touching.
+"""
+
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import arcpy
+
+from _cache import get_cache, METADATA
+
+__all__ = ["GeometryArray", "read_geometry", "STRtree", "read_bounds",
+           "spatial_index", "relate", "related", "spatial_join",
+           "MATCH_OPTIONS", "MERGE_RULES", "KDTree", "near_table"]
+
+# Segment (or vertex/segment) pairs tested at a time
+BATCH = 2000000
+# Query boxes searched in the tree at a time
+QUERY_BATCH = 100000
+# Distance (in the data's units) at which geometries touch
+TOLERANCE = 1e-9
+# Targets below which a join is never split across processes
+PARALLEL_MIN = 50000
+
+
+# =============================================================================
+# ARRAY HELPERS
+
+def _ranges(first, count):
+    """Flattens the ranges [first, first + count): (range index, position) of
+    every element.
+    """
+    count = np.asarray(count, dtype="i8")
+    owner = np.repeat(np.arange(len(count)), count)
+    offset = np.cumsum(count) - count
+    position = (np.arange(count.sum()) - np.repeat(offset, count)
+                + np.repeat(np.asarray(first, dtype="i8"), count))
+    return owner, position
+
+
+def _batches(work, limit=BATCH):
+    """Contiguous slices of items whose summed work is about limit."""
+    cum = np.cumsum(work)
+    start = 0
+    while start < len(cum):
+        done = cum[start - 1] if start else 0
+        end = max(int(np.searchsorted(cum, done + limit, "right")),
+                  start + 1)
+        yield slice(start, end)
+        start = end
+
+
+def _reduce(ufunc, values, work, empty):
+    """Reduces values per item given each item's (consecutive) work count."""
+    out = np.full(len(work), empty, dtype=np.asarray(values).dtype)
+    nonzero = work > 0
+    if nonzero.any():
+        starts = (np.cumsum(work) - work)[nonzero]
+        out[nonzero] = ufunc.reduceat(values, starts)
+    return out
+
+
+# =============================================================================
+# GEOMETRY ARRAYS
+
+class GeometryArray(object):
+    """Geometries of a feature class as flat arrays.
+    Attributes:
+        oids (array): OID of each geometry
+        shape_type (str): 'point', 'multipoint', 'polyline' or 'polygon'
+        xy (array): (m, 2) vertices of all geometries
+        parts (array): offsets of each part (or ring) into xy, and the end
+        geoms (array): offsets of each geometry into parts, and the end
+        centers (array): (n, 2) centroids
+        bounds (array): (n, 4) xmin, ymin, xmax, ymax; NaN for empty shapes
+        fields (OrderedDict): attribute arrays read with the geometries
+    """
+    def __init__(self, oids, shape_type, xy, parts, geoms, centers=None,
+                 fields=None):
+        self.oids = np.asarray(oids, dtype="i8")
+        self.shape_type = shape_type.lower()
+        self.xy = np.asarray(xy, dtype="f8").reshape(-1, 2)
+        self.parts = np.asarray(parts, dtype="i8")
+        self.geoms = np.asarray(geoms, dtype="i8")
+        self.fields = fields or OrderedDict()
+        self._segments = None
+        self._interior = None
+        vfirst, vcount = self.vertices()
+        self.bounds = np.full((len(self.oids), 4), np.nan)
+        nonempty = vcount > 0
+        if nonempty.any():
+            starts = vfirst[nonempty]
+            for j, (ufunc, axis) in enumerate([
+                    (np.minimum, 0), (np.minimum, 1),
+                    (np.maximum, 0), (np.maximum, 1)]):
+                self.bounds[nonempty, j] = ufunc.reduceat(
+                    self.xy[:, axis], starts)
+        if centers is None:
+            centers = self._centroids()
+        self.centers = np.asarray(centers, dtype="f8").reshape(-1, 2)
+
+    @classmethod
+    def from_shapes(cls, oids, shape_type, shapes, centers=None,
+                    fields=None):
+        """Builds the arrays from a list of shapes, each a list of parts
+        (lists of (x, y)); empty lists are empty shapes.
+        """
+        xy = [p for shape in shapes for part in shape for p in part]
+        parts = np.cumsum([0] + [len(part) for shape in shapes
+                                 for part in shape])
+        geoms = np.cumsum([0] + [len(shape) for shape in shapes])
+        return cls(oids, shape_type, xy, parts, geoms, centers, fields)
+
+    def __len__(self):
+        return len(self.oids)
+
+    @property
+    def is_polygon(self):
+        return self.shape_type == "polygon"
+
+    def vertices(self):
+        """Each geometry's first vertex (index into xy) and vertex count."""
+        first = self.parts[self.geoms[:-1]]
+        return first, self.parts[self.geoms[1:]] - first
+
+    def segments(self):
+        """Segments as (x0, y0, x1, y1) arrays, and each geometry's first
+        segment and segment count. A part of k vertices has k - 1 segments;
+        single vertices (points) are one zero-length segment.
+        """
+        if self._segments is None:
+            npts = np.diff(self.parts)
+            nseg = np.where(npts > 1, npts - 1, npts)
+            part, a = _ranges(self.parts[:-1], nseg)
+            b = a + (npts[part] > 1)
+            seg = np.column_stack([self.xy[a], self.xy[b]]).T
+            offsets = np.concatenate([[0], np.cumsum(nseg)])[self.geoms]
+            self._segments = (seg, offsets[:-1], np.diff(offsets))
+        return self._segments
+
+    def interior_points(self):
+        """A point strictly inside each polygon (as arcpy's labelPoint), even
+        when the centroid is not: the middle of the widest span of a
+        horizontal line halfway across the largest gap between the vertex
+        heights. NaN for empty or flat shapes.
+        """
+        if self._interior is not None:
+            return self._interior
+        n = len(self)
+        points = np.full((n, 2), np.nan)
+        vfirst, vcount = self.vertices()
+        owner, v = _ranges(vfirst, vcount)
+        order = np.lexsort((self.xy[v, 1], owner))
+        y, owner = self.xy[v, 1][order], owner[order]
+        # The line never passes through a vertex
+        gap = np.flatnonzero(owner[1:] == owner[:-1])
+        gap = gap[np.lexsort((y[gap] - y[gap + 1], owner[gap]))]
+        gap = gap[np.r_[True, owner[gap][1:] != owner[gap][:-1]]
+                  if len(gap) else []]
+        gap = gap[y[gap + 1] > y[gap]]
+        line = np.full(n, np.nan)
+        line[owner[gap]] = (y[gap] + y[gap + 1]) / 2.0
+        # Where the line crosses each geometry's segments, left to right
+        seg, first, count = self.segments()
+        x0, y0, x1, y1 = seg
+        owner = np.repeat(np.arange(n), count)
+        at = line[owner]
+        with np.errstate(invalid="ignore"):
+            hit = np.flatnonzero((y0 > at) != (y1 > at))
+        hit = hit[~np.isnan(at[hit])]
+        x = (x0[hit] + (at[hit] - y0[hit]) * (x1[hit] - x0[hit]) /
+             (y1[hit] - y0[hit]))
+        owner = owner[hit]
+        order = np.lexsort((x, owner))
+        x, owner = x[order], owner[order]
+        # Every other span between crossings is inside; take the widest
+        starts = np.r_[True, owner[1:] != owner[:-1]] if len(owner) else \
+            np.zeros(0, dtype=bool)
+        rank = np.arange(len(owner)) - np.maximum.accumulate(
+            np.where(starts, np.arange(len(owner)), 0))
+        span = np.flatnonzero((rank[:-1] % 2 == 0) &
+                              (owner[1:] == owner[:-1]))
+        span = span[np.lexsort((x[span] - x[span + 1], owner[span]))]
+        span = span[np.r_[True, owner[span][1:] != owner[span][:-1]]
+                    if len(span) else []]
+        g = owner[span]
+        points[g, 0] = (x[span] + x[span + 1]) / 2.0
+        points[g, 1] = line[g]
+        self._interior = points
+        return points
+
+    def _centroids(self):
+        """Area centroids of polygons, vertex means of anything else."""
+        n = len(self)
+        vfirst, vcount = self.vertices()
+        owner, v = _ranges(vfirst, vcount)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            centers = np.column_stack([
+                np.bincount(owner, self.xy[v, 0], n),
+                np.bincount(owner, self.xy[v, 1], n)]) / vcount[:, None]
+            if self.is_polygon:
+                seg, first, count = self.segments()
+                x0, y0, x1, y1 = seg
+                owner = np.repeat(np.arange(n), count)
+                cross = x0 * y1 - x1 * y0
+                area = np.bincount(owner, cross, n) * 3
+                cx = np.bincount(owner, (x0 + x1) * cross, n) / area
+                cy = np.bincount(owner, (y0 + y1) * cross, n) / area
+                ok = area != 0
+                centers[ok] = np.column_stack([cx, cy])[ok]
+        return centers
+
+    def take(self, index):
+        """The geometries at the given positions, as a new GeometryArray."""
+        index = np.asarray(index, dtype="i8")
+        pcount = self.geoms[index + 1] - self.geoms[index]
+        _, p = _ranges(self.geoms[index], pcount)
+        vcount = self.parts[p + 1] - self.parts[p]
+        _, v = _ranges(self.parts[p], vcount)
+        return GeometryArray(
+            self.oids[index], self.shape_type, self.xy[v],
+            np.concatenate([[0], np.cumsum(vcount)]),
+            np.concatenate([[0], np.cumsum(pcount)]), self.centers[index],
+            OrderedDict((name, col[index])
+                        for name, col in self.fields.items()))
+
+
+def _shape_parts(shape):
+    """Parts of an arcpy geometry as lists of (x, y). Interior rings, which
+    arcpy separates from their exterior ring with None, are parts too.
+    """
+    parts = []
+    for part in shape:
+        if hasattr(part, "X"):
+            # Multipoint
+            parts.append([(part.X, part.Y)])
+            continue
+        ring = []
+        for pnt in part:
+            if pnt is None:
+                parts.append(ring)
+                ring = []
+            else:
+                ring.append((pnt.X, pnt.Y))
+        parts.append(ring)
+    return [p for p in parts if p]
+
+
+def read_geometry(fc, fields=None, where=None, centroids=False,
+                  spatial_reference=None):
+    """Reads a feature class's (or layer's) geometries into a GeometryArray.
+    Args:
+        fc (str): path to a feature class, or a layer
+        fields (list): attribute fields to read in the same pass
+        where (str): optional where clause
+        centroids (bool): read each feature's centroid (as a point) instead
+            of its full shape
+        spatial_reference (SpatialReference): optional coordinate system to
+            read the shapes in (projected by the cursor)
+    Example:
+        >>> parcels = read_geometry("Parcels", ["ParcelID"])
+        >>> parcels.bounds[:2]
+    """
+    fields = list(fields or [])
+    shape_type = METADATA.describe(fc).shapeType.lower()
+    if shape_type == "point" or centroids:
+        token = "SHAPE@XY"
+    else:
+        token = "SHAPE@"
+    oids = []
+    shapes = []
+    centers = []
+    values = []
+    with arcpy.da.SearchCursor(fc, ["OID@", token] + fields, where,
+                               spatial_reference) as cur:
+        for row in cur:
+            oids.append(row[0])
+            values.append(row[2:])
+            shape = row[1]
+            if shape is None:
+                shapes.append([])
+                centers.append((np.nan, np.nan))
+            elif token == "SHAPE@XY":
+                shapes.append([[shape]])
+                centers.append(shape)
+            else:
+                shapes.append(_shape_parts(shape))
+                c = shape.centroid
+                centers.append((c.X, c.Y) if c else (np.nan, np.nan))
+    if token == "SHAPE@XY":
+        shape_type = "point"
+    columns = OrderedDict()
+    for i, name in enumerate(fields):
+        col = np.empty(len(values), dtype=object)
+        col[:] = [v[i] for v in values]
+        columns[name] = col
+    return GeometryArray.from_shapes(oids, shape_type, shapes, centers,
+                                     columns)
+
+
+# =============================================================================
+# PACKED R-TREES
+
+def _str_order(bounds, node_size):
+    """Sort-Tile-Recursive order of boxes: vertical slices by x, then y."""
+    n = len(bounds)
+    cx = bounds[:, 0] + bounds[:, 2]
+    cy = bounds[:, 1] + bounds[:, 3]
+    leaves = -(-n // node_size)
+    per_slice = int(np.ceil(np.sqrt(leaves))) * node_size
+    order = np.argsort(cx, kind="mergesort")
+    slices = np.arange(n) // per_slice
+    return order[np.lexsort((cy[order], slices))]
+
+
+def _hilbert(x, y, bits=16):
+    """Distance along a Hilbert curve of integer grid cells (vectorized)."""
+    n = 1 << bits
+    x = np.asarray(x, dtype="i8").copy()
+    y = np.asarray(y, dtype="i8").copy()
+    d = np.zeros(len(x), dtype="i8")
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype("i8")) ^ ry.astype("i8"))
+        # Rotate the quadrant
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= 1
+    return d
+
+
+def _hilbert_order(bounds, node_size, bits=16):
+    """Order of boxes along a Hilbert curve through their centers."""
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2.0
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2.0
+    cells = (1 << bits) - 1
+    if not len(cx):
+        return np.array([], dtype="i8")
+    span = max(cx.max() - cx.min(), cy.max() - cy.min()) or 1.0
+    gx = ((cx - cx.min()) / span * cells).astype("i8")
+    gy = ((cy - cy.min()) / span * cells).astype("i8")
+    return np.argsort(_hilbert(gx, gy, bits), kind="mergesort")
+
+
+_orders = {"str": _str_order, "hilbert": _hilbert_order}
+
+
+def _overlaps(a, b):
+    return ((a[:, 0] <= b[:, 2]) & (a[:, 2] >= b[:, 0]) &
+            (a[:, 1] <= b[:, 3]) & (a[:, 3] >= b[:, 1]))
+
+
+class STRtree(object):
+    """Packed R-tree over bounding boxes, sorted by Sort-Tile-Recursive or
+    along a Hilbert curve.
+    The tree is flat: the node boxes of all levels, leaves (the items' boxes)
+    first, in one (k, 4) array with the offset of each level. The children of
+    node i are nodes i * node_size to (i + 1) * node_size - 1 of the level
+    below, so nothing else is stored and a saved tree can be memory-mapped.
+    Queries descend all query boxes together, one level at a time.
+    Args:
+        bounds (array): (n, 4) xmin, ymin, xmax, ymax; NaN boxes are skipped
+        node_size (int): children per node
+        method (str): 'str' or 'hilbert' packing
+        oids (array): optional OID of each box, for query_oids
+    Example:
+        >>> tree = STRtree(neighborhoods.bounds)
+        >>> parcel_i, hood_i = tree.query(parcels.bounds)
+    """
+    def __init__(self, bounds, node_size=16, method="str", oids=None):
+        bounds = np.asarray(bounds, dtype="f8").reshape(-1, 4)
+        self.node_size = node_size
+        self.method = method.lower()
+        valid = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+        self.items = valid[_orders[self.method](bounds[valid], node_size)]
+        self.oids = None
+        if oids is not None:
+            self.oids = np.asarray(oids, dtype="i8")[self.items]
+        level = bounds[self.items]
+        levels = [level]
+        while len(level) > 1:
+            starts = np.arange(0, len(level), node_size)
+            level = np.column_stack([
+                np.minimum.reduceat(level[:, 0], starts),
+                np.minimum.reduceat(level[:, 1], starts),
+                np.maximum.reduceat(level[:, 2], starts),
+                np.maximum.reduceat(level[:, 3], starts)])
+            levels.append(level)
+        self.boxes = np.concatenate(levels)
+        self.offsets = np.cumsum([0] + [len(lv) for lv in levels])
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuilds a tree from its arrays (e.g. memory-mapped)."""
+        tree = cls.__new__(cls)
+        tree.boxes = arrays["boxes"]
+        tree.offsets = np.asarray(arrays["offsets"])
+        tree.items = arrays["items"]
+        tree.oids = arrays.get("oids")
+        tree.node_size = int(arrays["meta"][0])
+        tree.method = ("str", "hilbert")[int(arrays["meta"][1])]
+        return tree
+
+    def arrays(self):
+        """The arrays that make up the tree (see from_arrays)."""
+        arrays = {"boxes": self.boxes, "offsets": self.offsets,
+                  "items": self.items,
+                  "meta": np.array([self.node_size,
+                                    self.method == "hilbert"], dtype="i8")}
+        if self.oids is not None:
+            arrays["oids"] = self.oids
+        return arrays
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def levels(self):
+        """Node boxes of each level, leaves first."""
+        return [self.boxes[a:b]
+                for a, b in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def for_oids(self, oids):
+        """The tree with items renumbered as positions in oids (e.g. of a
+        GeometryArray read after the tree was saved); items whose OID is not
+        in oids are never returned.
+        """
+        tree = STRtree.from_arrays(self.arrays())
+        tree.items = pd.Index(np.asarray(oids)).get_indexer(self.oids)
+        return tree
+
+    def _query(self, boxes, q, levels):
+        nodes = np.zeros(len(q), dtype="i8")
+        keep = _overlaps(boxes[q], levels[-1][nodes])
+        q, nodes = q[keep], nodes[keep]
+        for level in reversed(levels[:-1]):
+            first = nodes * self.node_size
+            count = np.minimum(self.node_size, len(level) - first)
+            owner, nodes = _ranges(first, count)
+            q = q[owner]
+            keep = _overlaps(boxes[q], level[nodes])
+            q, nodes = q[keep], nodes[keep]
+        items = np.asarray(self.items[nodes])
+        found = items >= 0
+        return q[found], items[found], nodes[found]
+
+    def _search(self, boxes, distance):
+        boxes = np.asarray(boxes, dtype="f8").reshape(-1, 4)
+        if distance:
+            boxes = boxes + np.array([-distance, -distance,
+                                      distance, distance])
+        valid = np.flatnonzero(~np.isnan(boxes).any(axis=1))
+        if not len(self.items) or not len(valid):
+            empty = np.array([], dtype="i8")
+            return empty, empty, empty
+        levels = self.levels
+        found = [self._query(boxes, valid[i:i + QUERY_BATCH], levels)
+                 for i in range(0, len(valid), QUERY_BATCH)]
+        return tuple(np.concatenate([f[i] for f in found]) for i in range(3))
+
+    def query(self, boxes, distance=0.0):
+        """Candidate pairs: (query box index, item index) arrays of the items
+        whose boxes intersect each query box (grown by distance).
+        """
+        q, items, leaves = self._search(boxes, distance)
+        return q, items
+
+    def query_oids(self, boxes, distance=0.0):
+        """Sorted OIDs of the items whose boxes intersect any of the boxes
+        (e.g. a single (xmin, ymin, xmax, ymax)), grown by distance.
+        """
+        if self.oids is None:
+            raise ValueError("The tree was built without OIDs")
+        q, items, leaves = self._search(boxes, distance)
+        return np.unique(np.asarray(self.oids)[leaves])
+
+
+def read_bounds(fc, where=None):
+    """OIDs and (n, 4) bounding boxes of a feature class's features."""
+    points = METADATA.describe(fc).shapeType.lower() == "point"
+    token = "SHAPE@XY" if points else "SHAPE@"
+    oids = []
+    bounds = []
+    with arcpy.da.SearchCursor(fc, ["OID@", token], where) as cur:
+        for oid, shape in cur:
+            oids.append(oid)
+            if shape is None:
+                bounds.append((np.nan,) * 4)
+            elif points:
+                bounds.append(tuple(shape) * 2)
+            else:
+                e = shape.extent
+                bounds.append((e.XMin, e.YMin, e.XMax, e.YMax))
+    return (np.asarray(oids, dtype="i8"),
+            np.asarray(bounds, dtype="f8").reshape(-1, 4))
+
+
+def spatial_index(fc, cache=None, where=None, method="hilbert", node_size=16):
+    """Packed R-tree (with OIDs) of a feature class's bounding boxes.
+    With a cache, the tree's arrays are saved in it and memory-mapped by
+    later calls until the source changes, so repeated queries against a
+    static layer skip the scan.
+    Args:
+        fc (str): path to a feature class, or a layer
+        cache (SnapshotCache): optional cache; True uses the default folder
+        where (str): optional where clause
+        method (str): 'hilbert' or 'str' packing
+        node_size (int): children per node
+    Example:
+        >>> index = spatial_index("C:/data/city.gdb/Parcels", cache=True)
+        >>> index.query_oids((xmin, ymin, xmax, ymax))
+    """
+    cache = get_cache(cache)
+    extra = (where, method, node_size)
+    if cache:
+        arrays = cache.get_arrays(fc, "rtree", *extra)
+        if arrays is not None:
+            return STRtree.from_arrays(arrays)
+    oids, bounds = read_bounds(fc, where)
+    tree = STRtree(bounds, node_size, method, oids)
+    if cache:
+        cache.put_arrays(fc, "rtree", tree.arrays(), *extra)
+    return tree
+
+
+# =============================================================================
+# PREDICATES
+
+def _point_segment(px, py, x0, y0, x1, y1):
+    """Distance from points to segments (element-wise)."""
+    dx = x1 - x0
+    dy = y1 - y0
+    d2 = dx * dx + dy * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(d2 > 0, ((px - x0) * dx + (py - y0) * dy) / d2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(px - x0 - t * dx, py - y0 - t * dy)
+
+
+def _segment_pairs(a, b):
+    """Distance between segments a and b (element-wise), and whether they
+    cross properly (at a point interior to both).
+    """
+    ax0, ay0, ax1, ay1 = a
+    bx0, by0, bx1, by1 = b
+    d = np.minimum(
+        np.minimum(_point_segment(ax0, ay0, bx0, by0, bx1, by1),
+                   _point_segment(ax1, ay1, bx0, by0, bx1, by1)),
+        np.minimum(_point_segment(bx0, by0, ax0, ay0, ax1, ay1),
+                   _point_segment(bx1, by1, ax0, ay0, ax1, ay1)))
+    o1 = (ax1 - ax0) * (by0 - ay0) - (ay1 - ay0) * (bx0 - ax0)
+    o2 = (ax1 - ax0) * (by1 - ay0) - (ay1 - ay0) * (bx1 - ax0)
+    o3 = (bx1 - bx0) * (ay0 - by0) - (by1 - by0) * (ax0 - bx0)
+    o4 = (bx1 - bx0) * (ay1 - by0) - (by1 - by0) * (ax1 - bx0)
+    crosses = (o1 * o2 < 0) & (o3 * o4 < 0)
+    d[crosses] = 0.0
+    return d, crosses
+
+
+def _pair_segments(A, ia, B, ib):
+    """For each pair of geometries: the distance between their segments and
+    whether any of them cross properly.
+    """
+    sega, firsta, counta = A.segments()
+    segb, firstb, countb = B.segments()
+    na = counta[ia]
+    nb = countb[ib]
+    work = na * nb
+    dist = np.full(len(ia), np.inf)
+    crosses = np.zeros(len(ia), dtype=bool)
+    for sl in _batches(work):
+        w = work[sl]
+        owner, local = _ranges(np.zeros(len(w)), w)
+        nbo = nb[sl][owner]
+        sa = firsta[ia[sl]][owner] + local // nbo
+        sb = firstb[ib[sl]][owner] + local % nbo
+        d, c = _segment_pairs(sega[:, sa], segb[:, sb])
+        dist[sl] = _reduce(np.minimum, d, w, np.inf)
+        crosses[sl] = _reduce(np.logical_or, c, w, False)
+    return dist, crosses
+
+
+def _points_in(B, ib, px, py):
+    """Whether points are inside polygons ib of B (even-odd rule over all
+    rings), and their distance to the polygons' boundaries.
+    """
+    seg, first, count = B.segments()
+    work = count[ib]
+    inside = np.zeros(len(ib), dtype=bool)
+    dist = np.full(len(ib), np.inf)
+    for sl in _batches(work):
+        w = work[sl]
+        owner, s = _ranges(first[ib[sl]], w)
+        x, y = px[sl][owner], py[sl][owner]
+        x0, y0, x1, y1 = seg[:, s]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cross = (((y0 > y) != (y1 > y)) &
+                     (x < (x1 - x0) * (y - y0) / (y1 - y0) + x0))
+        inside[sl] = _reduce(np.add, cross.astype("i8"), w, 0) % 2 == 1
+        dist[sl] = _reduce(np.minimum, _point_segment(x, y, x0, y0, x1, y1),
+                           w, np.inf)
+    return inside, dist
+
+
+def _first_vertex_in(A, ia, B, ib):
+    """Whether the first vertex of each A is strictly inside polygon B."""
+    vfirst, vcount = A.vertices()
+    has = vcount[ia] > 0
+    result = np.zeros(len(ia), dtype=bool)
+    v = vfirst[ia[has]]
+    inside, dist = _points_in(B, ib[has], A.xy[v, 0], A.xy[v, 1])
+    result[has] = inside & (dist > TOLERANCE)
+    return result
+
+
+def _any_in(xy, first, count, ia, B, ib):
+    """Whether any of the points xy[first[i]:first[i] + count[i]] of each
+    pair's i (ia) is strictly inside polygon B.
+    """
+    segb, firstb, countb = B.segments()
+    result = np.zeros(len(ia), dtype=bool)
+    for sl in _batches(count[ia] * countb[ib]):
+        owner, v = _ranges(first[ia[sl]], count[ia[sl]])
+        inside, dist = _points_in(B, ib[sl][owner], xy[v, 0], xy[v, 1])
+        result[sl] = _reduce(np.logical_or, inside & (dist > TOLERANCE),
+                             count[ia[sl]], False)
+    return result
+
+
+def _any_vertex_in(A, ia, B, ib):
+    """Whether any vertex of each A is strictly inside polygon B."""
+    vfirst, vcount = A.vertices()
+    return _any_in(A.xy, vfirst, vcount, ia, B, ib)
+
+
+def _line_ends(G):
+    """Boundary points of each geometry: the ends of its open polyline parts
+    (points and polygons have none), as indices into G.xy, and each
+    geometry's first end and end count.
+    """
+    n = len(G)
+    if G.shape_type != "polyline":
+        return np.zeros(0, dtype="i8"), np.zeros(n, "i8"), np.zeros(n, "i8")
+    first = G.parts[:-1]
+    last = G.parts[1:] - 1
+    part = np.flatnonzero(last > first)
+    gap = G.xy[last[part]] - G.xy[first[part]]
+    part = part[np.hypot(gap[:, 0], gap[:, 1]) > TOLERANCE]
+    ends = np.column_stack([first[part], last[part]]).ravel()
+    count = 2 * np.bincount(np.repeat(np.arange(n), np.diff(G.geoms))[part],
+                            minlength=n)
+    return ends, np.cumsum(count) - count, count
+
+
+def _split_midpoints(A, ia, B, ib):
+    """Midpoints of the pieces of each A's segments once split at B's
+    vertices lying on them: (pair index, x, y). Pieces no longer than twice
+    the tolerance are left out.
+    """
+    seg, first, count = A.segments()
+    vfirst, vcount = B.vertices()
+    x0, y0, x1, y1 = seg
+    dx = x1 - x0
+    dy = y1 - y0
+    d2 = dx * dx + dy * dy
+    na = count[ia]
+    nb = vcount[ib]
+    # Every segment is split at its ends...
+    owner, s = _ranges(first[ia], na)
+    owners, segs, params = [owner, owner], [s, s], [np.zeros(len(s)),
+                                                    np.ones(len(s))]
+    # ...and wherever one of B's vertices touches it
+    work = na * nb
+    for sl in _batches(work):
+        w = work[sl]
+        owner, local = _ranges(np.zeros(len(w)), w)
+        nbo = nb[sl][owner]
+        s = first[ia[sl]][owner] + local // nbo
+        v = vfirst[ib[sl]][owner] + local % nbo
+        px, py = B.xy[v, 0], B.xy[v, 1]
+        on = ((_point_segment(px, py, x0[s], y0[s], x1[s], y1[s])
+               <= TOLERANCE) & (d2[s] > 0))
+        s, owner = s[on], owner[on]
+        owners.append(sl.start + owner)
+        segs.append(s)
+        params.append(np.clip(((px[on] - x0[s]) * dx[s] +
+                               (py[on] - y0[s]) * dy[s]) / d2[s], 0.0, 1.0))
+    owner, s, t = (np.concatenate(a) for a in (owners, segs, params))
+    order = np.lexsort((t, s, owner))
+    owner, s, t = owner[order], s[order], t[order]
+    piece = np.flatnonzero((owner[1:] == owner[:-1]) & (s[1:] == s[:-1]))
+    t0, t1 = t[piece], t[piece + 1]
+    owner, s = owner[piece], s[piece]
+    keep = (t1 - t0) * np.sqrt(d2[s]) > 2 * TOLERANCE
+    owner, s, t = owner[keep], s[keep], ((t0 + t1) / 2.0)[keep]
+    return owner, x0[s] + t * dx[s], y0[s] + t * dy[s]
+
+
+def _pieces_in(A, ia, B, ib):
+    """Whether a piece of each A's segments (split where B's vertices touch
+    them) runs through B's interior: strictly inside a polygon, or along a
+    polyline.
+    """
+    owner, x, y = _split_midpoints(A, ia, B, ib)
+    inside, dist = _points_in(B, ib[owner], x, y)
+    if B.is_polygon:
+        hit = inside & (dist > TOLERANCE)
+    else:
+        hit = dist <= TOLERANCE
+    result = np.zeros(len(ia), dtype=bool)
+    result[owner[hit]] = True
+    return result
+
+
+def _interior_in(A, ia, B, ib):
+    """Whether each A reaches into the interior of polygon B: any vertex or
+    piece of a segment of A, or (for polygons) a point inside A, strictly
+    inside it.
+    """
+    result = _any_vertex_in(A, ia, B, ib)
+    rest = np.flatnonzero(~result)
+    result[rest] = _pieces_in(A, ia[rest], B, ib[rest])
+    # Every point of A's boundary can be on B's (e.g. identical shapes)
+    if A.is_polygon:
+        n = len(A)
+        rest = np.flatnonzero(~result)
+        result[rest] = _any_in(A.interior_points(), np.arange(n),
+                               np.ones(n, dtype="i8"), ia[rest], B, ib[rest])
+    return result
+
+
+def _at_ends(G, ig, px, py):
+    """Whether each point is at one of the ends of geometry ig of G."""
+    ends, first, count = _line_ends(G)
+    n = count[ig]
+    k, e = _ranges(first[ig], n)
+    near = np.hypot(G.xy[ends[e], 0] - px[k],
+                    G.xy[ends[e], 1] - py[k]) <= TOLERANCE
+    return _reduce(np.logical_or, near, n, False)
+
+
+def _interior_contact(A, ia, B, ib):
+    """Whether an interior vertex of each A (any not at the ends of a
+    polyline) is on B, away from B's own ends. Neither may be a polygon.
+    """
+    vfirst, vcount = A.vertices()
+    owner, v = _ranges(vfirst[ia], vcount[ia])
+    px, py = A.xy[v, 0], A.xy[v, 1]
+    inner = np.flatnonzero(~_at_ends(A, ia[owner], px, py))
+    inside, dist = _points_in(B, ib[owner[inner]], px[inner], py[inner])
+    on = inner[dist <= TOLERANCE]
+    on = on[~_at_ends(B, ib[owner[on]], px[on], py[on])]
+    result = np.zeros(len(ia), dtype=bool)
+    result[owner[on]] = True
+    return result
+
+
+def _vertices_on(A, ia, B, ib):
+    """Whether every vertex of each A is in (or on) B."""
+    vfirst, vcount = A.vertices()
+    segb, firstb, countb = B.segments()
+    result = np.zeros(len(ia), dtype=bool)
+    for sl in _batches(vcount[ia] * countb[ib]):
+        owner, v = _ranges(vfirst[ia[sl]], vcount[ia[sl]])
+        inside, dist = _points_in(B, ib[sl][owner], A.xy[v, 0], A.xy[v, 1])
+        ok = dist <= TOLERANCE
+        if B.is_polygon:
+            ok |= inside
+        result[sl] = _reduce(np.logical_and, ok, vcount[ia[sl]], False)
+    return result
+
+
+def _point_distance(A, ia, B, ib):
+    """Distance from points A to polygons B (0 inside them)."""
+    xy = A.xy[A.vertices()[0][ia]]
+    inside, dist = _points_in(B, ib, xy[:, 0], xy[:, 1])
+    dist[inside] = 0.0
+    return dist
+
+
+def _distance(A, ia, B, ib):
+    """Planar distance between the geometries of each pair (0 if they
+    intersect).
+    """
+    if A.shape_type == "point" and B.is_polygon:
+        return _point_distance(A, ia, B, ib)
+    if B.shape_type == "point" and A.is_polygon:
+        return _point_distance(B, ib, A, ia)
+    dist, crosses = _pair_segments(A, ia, B, ib)
+    # Without touching boundaries, a shape is inside a polygon (or holds
+    #  it) entirely, so one vertex tells
+    if B.is_polygon:
+        dist[_first_vertex_in(A, ia, B, ib)] = 0.0
+    if A.is_polygon:
+        dist[_first_vertex_in(B, ib, A, ia)] = 0.0
+    return dist
+
+
+def _within(A, ia, B, ib):
+    """Whether each A is within B (boundaries may touch)."""
+    result = _vertices_on(A, ia, B, ib)
+    rest = np.flatnonzero(result)
+    # Every vertex inside can still leave a concave polygon between two
+    #  vertices, or surround one of its holes
+    dist, crosses = _pair_segments(A, ia[rest], B, ib[rest])
+    result[rest[crosses]] = False
+    if A.is_polygon:
+        rest = np.flatnonzero(result)
+        result[rest] = ~_any_vertex_in(B, ib[rest], A, ia[rest])
+    return result
+
+
+def _intersect(A, ia, B, ib, distance):
+    return _distance(A, ia, B, ib) <= max(distance, TOLERANCE)
+
+
+def _contains(A, ia, B, ib, distance):
+    return _within(B, ib, A, ia)
+
+
+def _center_in(A, ia, B, ib, distance):
+    inside, dist = _points_in(B, ib, A.centers[ia, 0], A.centers[ia, 1])
+    if B.is_polygon:
+        return inside | (dist <= TOLERANCE)
+    return dist <= TOLERANCE
+
+
+def _touches(A, ia, B, ib, distance):
+    """Whether the boundaries of each pair touch without their interiors
+    meeting. A point's interior is the point itself, and a polyline's all
+    of it but the ends of its open parts.
+    """
+    result = _distance(A, ia, B, ib) <= TOLERANCE
+    rest = np.flatnonzero(result)
+    dist, crosses = _pair_segments(A, ia[rest], B, ib[rest])
+    result[rest[crosses]] = False
+    for X, ix, Y, iy in [(A, ia, B, ib), (B, ib, A, ia)]:
+        rest = np.flatnonzero(result)
+        if Y.is_polygon:
+            result[rest] = ~_interior_in(X, ix[rest], Y, iy[rest])
+        elif not X.is_polygon:
+            result[rest] = ~_interior_contact(X, ix[rest], Y, iy[rest])
+    # Polylines can also overlap along a stretch between vertices
+    if A.shape_type == B.shape_type == "polyline":
+        rest = np.flatnonzero(result)
+        result[rest] = ~_pieces_in(A, ia[rest], B, ib[rest])
+    return result
+
+
+def _identical(A, ia, B, ib, distance):
+    same = _within(A, ia, B, ib)
+    rest = np.flatnonzero(same)
+    same[rest] = _within(B, ib[rest], A, ia[rest])
+    return same
+
+
+# Match options (as SpatialJoin_analysis names them) and their tests
+MATCH_OPTIONS = OrderedDict([
+    ("INTERSECT", _intersect),
+    ("WITHIN_A_DISTANCE", _intersect),
+    ("CONTAINS", _contains),
+    ("WITHIN", lambda A, ia, B, ib, distance: _within(A, ia, B, ib)),
+    ("HAVE_THEIR_CENTER_IN", _center_in),
+    ("BOUNDARY_TOUCHES", _touches),
+    ("ARE_IDENTICAL_TO", _identical)])
+
+
+def relate(targets, joins, match_option="INTERSECT", distance=0.0,
+           tree=None):
+    """Pairs of related geometries.
+    Args:
+        targets (GeometryArray): geometries to find matches for
+        joins (GeometryArray): geometries to match
+        match_option (str): one of MATCH_OPTIONS (as SpatialJoin_analysis)
+        distance (float): search distance for INTERSECT and WITHIN_A_DISTANCE
+        tree (STRtree): optional prebuilt tree over joins.bounds
+    Returns (target indexes, join indexes) of every related pair.
+    Example:
+        >>> ti, ji = relate(parcels, zoning, "HAVE_THEIR_CENTER_IN")
+    """
+    match_option = match_option.upper()
+    test = MATCH_OPTIONS[match_option]
+    if match_option not in ("INTERSECT", "WITHIN_A_DISTANCE"):
+        distance = 0.0
+    if tree is None:
+        tree = STRtree(joins.bounds)
+    if match_option == "HAVE_THEIR_CENTER_IN":
+        boxes = np.column_stack([targets.centers, targets.centers])
+    else:
+        boxes = targets.bounds
+    ti, ji = tree.query(boxes, max(distance, TOLERANCE))
+    keep = test(targets, ti, joins, ji, distance)
+    return ti[keep], ji[keep]
+
+
+def related(targets, joins, match_option="INTERSECT", distance=0.0,
+            tree=None):
+    """Positions of the targets related to any of the joins, as
+    SelectLayerByLocation_management selects them (e.g. 'WITHIN': targets
+    within a join geometry).
+    Args:
+        targets (GeometryArray): geometries to select from
+        joins (GeometryArray): geometries to select by
+        match_option (str): one of MATCH_OPTIONS
+        distance (float): search distance for INTERSECT and WITHIN_A_DISTANCE
+        tree (STRtree): optional prebuilt tree over targets.bounds (e.g. a
+            cached spatial_index(...).for_oids(targets.oids))
+    Example:
+        >>> parcels.oids[related(parcels, floodplain, "HAVE_THEIR_CENTER_IN")]
+    """
+    match_option = match_option.upper()
+    test = MATCH_OPTIONS[match_option]
+    if match_option not in ("INTERSECT", "WITHIN_A_DISTANCE"):
+        distance = 0.0
+    if tree is None:
+        tree = STRtree(targets.bounds)
+    ji, ti = tree.query(joins.bounds, max(distance, TOLERANCE))
+    keep = test(targets, ti, joins, ji, distance)
+    return np.unique(ti[keep])
+
+
+# =============================================================================
+# JOINS
+
+# Merge rules (as field maps name them) supported in-process
+MERGE_RULES = ("FIRST", "LAST", "SUM", "MEAN", "MIN", "MAX", "COUNT")
+
+# Join features and tree shared by the processes of a parallel join
+_shared = {}
+
+
+def _init_worker(joins, tree):
+    _shared["joins"] = joins
+    _shared["tree"] = tree
+
+
+def _relate_part(args):
+    """Worker: relates a block of targets to the shared join features."""
+    targets, match_option, distance = args
+    return relate(targets, _shared["joins"], match_option, distance,
+                  _shared["tree"])
+
+
+def _relate_parallel(targets, joins, match_option, distance, tree, workers):
+    """relate, with the targets split into spatially compact blocks."""
+    centers = np.column_stack([targets.centers, targets.centers])
+    order = _str_order(np.nan_to_num(centers), 1)
+    blocks = np.array_split(order, workers * 4)
+    pool = Pool(workers, _init_worker, (joins, tree))
+    try:
+        results = pool.map(
+            _relate_part,
+            [(targets.take(b), match_option, distance) for b in blocks])
+    finally:
+        pool.close()
+        pool.join()
+    ti = np.concatenate([b[r[0]] for b, r in zip(blocks, results)])
+    ji = np.concatenate([r[1] for r in results])
+    return ti, ji
+
+
+def _merge(ti, ji, values, n, merge_rule):
+    """Merges the join values of each target's pairs; None where a target
+    has no (non-NULL) values.
+    """
+    rule = merge_rule.upper()
+    out = np.empty(n, dtype=object)
+    if rule in ("FIRST", "LAST"):
+        # First/last join feature in the join features' order
+        order = np.lexsort((ji, ti))
+        t = ti[order]
+        if rule == "FIRST":
+            pick = np.flatnonzero(np.r_[True, t[1:] != t[:-1]])
+        else:
+            pick = np.flatnonzero(np.r_[t[1:] != t[:-1], True])
+        if len(t):
+            out[t[pick]] = values[ji[order][pick]]
+        return out
+    vals = values[ji]
+    valid = pd.notnull(vals)
+    ti = ti[valid]
+    vals = vals[valid]
+    counts = np.bincount(ti, minlength=n)
+    matched = counts > 0
+    if rule == "COUNT":
+        out[matched] = counts[matched].tolist()
+        return out
+    if rule in ("SUM", "MEAN"):
+        numbers = np.asarray(vals.tolist())
+        sums = np.bincount(ti, numbers.astype("f8"), minlength=n)
+        if rule == "MEAN":
+            out[matched] = (sums[matched] / counts[matched]).tolist()
+        elif numbers.dtype.kind in "iub":
+            out[matched] = sums[matched].round().astype("i8").tolist()
+        else:
+            out[matched] = sums[matched].tolist()
+        return out
+    # MIN/MAX: sort by value, then (stably) by target
+    order = np.argsort(vals, kind="mergesort")
+    order = order[np.argsort(ti[order], kind="mergesort")]
+    t = ti[order]
+    if rule == "MIN":
+        pick = np.flatnonzero(np.r_[True, t[1:] != t[:-1]])
+    else:
+        pick = np.flatnonzero(np.r_[t[1:] != t[:-1], True])
+    if len(t):
+        out[t[pick]] = vals[order][pick]
+    return out
+
+
+def spatial_join(targets, joins, values, merge_rule,
+                 match_option="INTERSECT", distance=0.0, workers=1,
+                 tree=None):
+    """Merged join values for each target geometry.
+    Args:
+        targets (GeometryArray): geometries to calculate values for
+        joins (GeometryArray): geometries to take values from
+        values (array): a value per join geometry (e.g. joins.fields[name])
+        merge_rule (str): one of MERGE_RULES; NULL values are ignored by all
+            but FIRST and LAST
+        match_option (str): one of MATCH_OPTIONS
+        distance (float): search distance (see relate)
+        workers (int): processes to split large targets across (stand-alone
+            scripts only; not from ArcMap's Python Window)
+        tree (STRtree): optional prebuilt tree over joins.bounds (e.g. a
+            cached spatial_index(...).for_oids(joins.oids))
+    Returns an object array of a value per target (None if nothing matched).
+    Example:
+        >>> permits = read_geometry("Permits", ["Dwellings"])
+        >>> parcels = read_geometry("Parcels")
+        >>> spatial_join(parcels, permits, permits.fields["Dwellings"], "SUM")
+    """
+    if merge_rule.upper() not in MERGE_RULES:
+        raise ValueError("Unsupported merge rule {}".format(merge_rule))
+    values = np.asarray(values, dtype=object)
+    if tree is None:
+        tree = STRtree(joins.bounds)
+    if workers > 1 and len(targets) >= PARALLEL_MIN:
+        ti, ji = _relate_parallel(targets, joins, match_option, distance,
+                                  tree, workers)
+    else:
+        ti, ji = relate(targets, joins, match_option, distance, tree)
+    return _merge(ti, ji, values, len(targets), merge_rule)
+
+
+# =============================================================================
+# NEAREST NEIGHBOURS
+
+# Mean Earth radius (meters) of geodesic distances
+EARTH_RADIUS = 6371008.8
+
+
+def _unit_vectors(lonlat):
+    """3D unit vectors of longitude/latitude degrees."""
+    lon = np.radians(lonlat[:, 0])
+    lat = np.radians(lonlat[:, 1])
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def _min_dist2(q, lo, hi):
+    """Squared distance from points to boxes (0 inside them)."""
+    gap = np.maximum(np.maximum(lo - q, q - hi), 0.0)
+    return (gap * gap).sum(axis=1)
+
+
+def _top_k(qi, pos, d2, k):
+    """The k smallest distances of each query, sorted."""
+    order = np.lexsort((d2, qi))
+    qi, pos, d2 = qi[order], pos[order], d2[order]
+    start = np.flatnonzero(np.r_[True, qi[1:] != qi[:-1]])
+    rank = np.arange(len(qi)) - np.repeat(start, np.diff(np.r_[start,
+                                                                len(qi)]))
+    keep = rank < k if k else np.ones(len(qi), dtype=bool)
+    return qi[keep], pos[keep], d2[keep], rank[keep]
+
+
+class KDTree(object):
+    """Balanced k-d tree over points, queried in vectorized batches.
+    The tree is flat: points are reordered so that every node covers a
+    contiguous range of them, node i's children are nodes 2i + 1 and 2i + 2,
+    and all leaves are at the same depth. Queries descend all query points
+    together, pruning nodes farther away than each query's search radius.
+    With geodesic=True, coordinates are longitude/latitude degrees. They are
+    indexed as unit vectors, whose chord lengths order neighbours exactly as
+    great-circle distances do, and distances are great-circle meters on a
+    sphere of EARTH_RADIUS.
+    Args:
+        xy (array): (n, 2) coordinates; NaN points are skipped
+        oids (array): OID of each point (default: their positions)
+        leaf_size (int): most points per leaf
+        geodesic (bool): longitude/latitude input and distances in meters
+    Example:
+        >>> hydrants = read_geometry("Hydrants")
+        >>> tree = KDTree(hydrants.centers, hydrants.oids)
+        >>> oids, dist = tree.nearest(parcels.centers, k=2)
+    """
+    def __init__(self, xy, oids=None, leaf_size=16, geodesic=False):
+        xy = np.asarray(xy, dtype="f8").reshape(-1, 2)
+        if oids is None:
+            oids = np.arange(len(xy))
+        valid = ~np.isnan(xy).any(axis=1)
+        xy = xy[valid]
+        oids = np.asarray(oids, dtype="i8")[valid]
+        self.geodesic = geodesic
+        pts = _unit_vectors(xy) if geodesic else xy
+        n = len(pts)
+        depth = 0
+        while n > leaf_size * 2 ** depth:
+            depth += 1
+        order = np.arange(n)
+        bounds = np.array([0, n])
+        for level in range(depth):
+            # Split every node of the level at the median of its widest
+            #  dimension
+            starts = bounds[:-1]
+            sizes = np.diff(bounds)
+            node = np.repeat(np.arange(len(sizes)), sizes)
+            p = pts[order]
+            low = np.minimum.reduceat(p, starts, axis=0)
+            spread = np.maximum.reduceat(p, starts, axis=0) - low
+            dim = np.argmax(spread, axis=1)
+            # The node number plus the coordinate scaled into [0, 1) sorts
+            #  every node's points at once
+            key = ((p[np.arange(n), dim[node]] - low[node, dim[node]]) /
+                   (spread[node, dim[node]] * (1 + 1e-9) + 1e-300))
+            order = order[np.argsort(node + key)]
+            mids = starts + sizes // 2
+            bounds = np.append(np.column_stack([starts, mids]).ravel(), n)
+        self.depth = depth
+        self.leaf_size = leaf_size
+        self.pts = pts[order]
+        self.xy = xy[order]
+        self.oids = oids[order]
+        self.starts = bounds
+        # Node boxes in heap order, built from the leaves up
+        if n:
+            lo = np.minimum.reduceat(self.pts, bounds[:-1], axis=0)
+            hi = np.maximum.reduceat(self.pts, bounds[:-1], axis=0)
+        else:
+            lo = hi = np.empty((0, pts.shape[1]))
+        levels = [(lo, hi)]
+        while len(lo) > 1:
+            lo = lo.reshape(-1, 2, lo.shape[1]).min(axis=1)
+            hi = hi.reshape(-1, 2, hi.shape[1]).max(axis=1)
+            levels.append((lo, hi))
+        self.lo = np.concatenate([lv[0] for lv in reversed(levels)])
+        self.hi = np.concatenate([lv[1] for lv in reversed(levels)])
+
+    def __len__(self):
+        return len(self.oids)
+
+    def _points(self, xy):
+        xy = np.asarray(xy, dtype="f8").reshape(-1, 2)
+        return _unit_vectors(xy) if self.geodesic else xy
+
+    def _radius2(self, distance):
+        """Squared search radius in tree units of a distance."""
+        if distance is None:
+            return np.inf
+        if self.geodesic:
+            angle = min(distance / EARTH_RADIUS, np.pi)
+            return (2 * np.sin(angle / 2)) ** 2
+        return float(distance) ** 2
+
+    def _distance(self, d2):
+        d = np.sqrt(d2)
+        if self.geodesic:
+            return 2 * EARTH_RADIUS * np.arcsin(np.minimum(d / 2, 1.0))
+        return d
+
+    def _candidates(self, q, radius2):
+        """(query, point position, squared distance) of the points within
+        each query's radius.
+        """
+        if not len(self):
+            empty = np.array([], dtype="i8")
+            return empty, empty, np.array([])
+        qi = np.arange(len(q))
+        node = np.zeros(len(q), dtype="i8")
+        for level in range(self.depth + 1):
+            heap = 2 ** level - 1 + node
+            keep = _min_dist2(q[qi], self.lo[heap],
+                              self.hi[heap]) <= radius2[qi]
+            qi, node = qi[keep], node[keep]
+            if level < self.depth:
+                qi = np.repeat(qi, 2)
+                node = (node[:, None] * 2 + np.array([0, 1])).ravel()
+        owner, pos = _ranges(self.starts[node], np.diff(self.starts)[node])
+        qi = qi[owner]
+        diff = self.pts[pos] - q[qi]
+        d2 = (diff * diff).sum(axis=1)
+        keep = d2 <= radius2[qi]
+        return qi[keep], pos[keep], d2[keep]
+
+    def _bound(self, q, k):
+        """Squared distance to the k-th nearest point of a subtree holding
+        each query point: an upper bound of its k-th nearest neighbour.
+        """
+        up = 0
+        while (len(self) // 2 ** self.depth) * 2 ** up < k and \
+                up < self.depth:
+            up += 1
+        level = self.depth - up
+        node = np.zeros(len(q), dtype="i8")
+        for lv in range(level):
+            # Into the nearer child
+            left = 2 ** (lv + 1) - 1 + node * 2
+            d_left = _min_dist2(q, self.lo[left], self.hi[left])
+            d_right = _min_dist2(q, self.lo[left + 1], self.hi[left + 1])
+            node = node * 2 + (d_right < d_left)
+        first = self.starts[node * 2 ** up]
+        last = self.starts[(node + 1) * 2 ** up]
+        owner, pos = _ranges(first, last - first)
+        diff = self.pts[pos] - q[owner]
+        qi, pos, d2, rank = _top_k(owner, pos, (diff * diff).sum(axis=1), k)
+        bound = np.full(len(q), np.inf)
+        full = rank == k - 1
+        bound[qi[full]] = d2[full]
+        return bound
+
+    def nearest(self, xy, k=1, max_distance=None):
+        """The k nearest points of each query point.
+        Args:
+            xy (array): (m, 2) query coordinates
+            k (int): neighbours per query
+            max_distance (float): optional search radius
+        Returns (oids, distances), both (m, k) and sorted by distance;
+        missing neighbours are OID -1 at distance inf.
+        """
+        q = self._points(xy)
+        oids = np.full((len(q), k), -1, dtype="i8")
+        dist = np.full((len(q), k), np.inf)
+        if not len(self):
+            return oids, dist
+        for i in range(0, len(q), QUERY_BATCH):
+            batch = q[i:i + QUERY_BATCH]
+            # Pad the bound for rounding in the distance sums
+            radius2 = np.minimum(self._bound(batch, k) * (1 + 1e-9),
+                                 self._radius2(max_distance))
+            qi, pos, d2 = self._candidates(batch, radius2)
+            qi, pos, d2, rank = _top_k(qi, pos, d2, k)
+            oids[i + qi, rank] = self.oids[pos]
+            dist[i + qi, rank] = self._distance(d2)
+        return oids, dist
+
+    def within(self, xy, distance):
+        """All points within distance of each query point.
+        Returns (query index, oids, distances) arrays sorted by query, then
+        distance.
+        """
+        q = self._points(xy)
+        if not len(self) or not len(q):
+            return (np.array([], dtype="i8"), np.array([], dtype="i8"),
+                    np.array([]))
+        found = []
+        for i in range(0, len(q), QUERY_BATCH):
+            batch = q[i:i + QUERY_BATCH]
+            radius2 = np.full(len(batch), self._radius2(distance))
+            qi, pos, d2 = self._candidates(batch, radius2)
+            qi, pos, d2, rank = _top_k(qi, pos, d2, None)
+            found.append((i + qi, self.oids[pos], self._distance(d2)))
+        return tuple(np.concatenate([f[j] for f in found]) for j in range(3))
+
+
+def near_table(in_features, near_features, k=1, search_radius=None,
+               geodesic=False, where=None):
+    """Nearest near_features of every input feature, as
+    GenerateNearTable_analysis reports them, from one k-d tree query.
+    Points are used as they are; other shapes by their centroids.
+    Args:
+        in_features (str): features to find neighbours for
+        near_features (str): candidate neighbours (e.g. hydrants)
+        k (int): neighbours per feature; None for all within search_radius
+        search_radius (float): optional limit, in the features' units (or
+            meters if geodesic)
+        geodesic (bool): great-circle distances (the features are read in
+            WGS 1984)
+        where (str): optional where clause on in_features
+    Returns a dataframe of IN_FID, NEAR_FID, NEAR_DIST and NEAR_RANK (from
+    1), sorted by IN_FID and distance.
+    Example:
+        >>> near_table("Parcels", "Hydrants", k=2)
+    """
+    if k is None and search_radius is None:
+        raise ValueError("k=None needs a search_radius")
+    sr = arcpy.SpatialReference(4326) if geodesic else None
+    targets = read_geometry(in_features, where=where, centroids=True,
+                            spatial_reference=sr)
+    near = read_geometry(near_features, centroids=True, spatial_reference=sr)
+    tree = KDTree(near.centers, near.oids, geodesic=geodesic)
+    if k is None:
+        qi, oids, dist = tree.within(targets.centers, search_radius)
+        qi, pos, d, rank = _top_k(qi, np.arange(len(qi)), dist, None)
+        oids, dist = oids[pos], dist[pos]
+    else:
+        oids, dist = tree.nearest(targets.centers, k, search_radius)
+        qi, rank = np.nonzero(oids >= 0)
+        oids, dist = oids[qi, rank], dist[qi, rank]
+    return pd.DataFrame(OrderedDict([
+        ("IN_FID", targets.oids[qi]), ("NEAR_FID", oids),
+        ("NEAR_DIST", dist), ("NEAR_RANK", rank + 1)]))
@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+"""
+_stats.py -- Streaming Table Statistics
+Author: Garin Wally
+License: MIT
+
+Summaries computed in a single cursor pass. Rows are pulled in chunks and
+reduced into per-group state, so memory depends on the number of groups (not
+rows) and no dataframe of the whole table is built.
+Duplicate detection can spill hash partitions to disk for tables whose keys
+do not fit in memory.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+from collections import Counter, OrderedDict
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+import arcpy
+
+from _cache import METADATA
+from _core import CHUNKSIZE, _as_list, _column, _field_dtypes
+
+__all__ = ["STATISTICS", "aggregate", "groupby", "find_duplicates",
+           "is_unique", "profile_table"]
+
+# Statistic types (as named by ArcGIS' Summary Statistics tool)
+STATISTICS = ("SUM", "COUNT", "MEAN", "MIN", "MAX", "UNIQUE", "FIRST",
+              "LAST")
+
+
+def _iter_columns(tbl, fields, chunksize=CHUNKSIZE, where=None):
+    """Yields (raw, typed) column lists for chunks of at most chunksize rows.
+    raw columns are tuples of cursor values (None for NULL); typed columns are
+    arrays as loaded by tbl2df (NaN/NaT for NULL, objects for text).
+    """
+    dtypes = _field_dtypes(tbl, fields)
+    with arcpy.da.SearchCursor(tbl, fields, where) as cur:
+        rows = list(islice(cur, chunksize))
+        while rows:
+            raw = list(zip(*rows))
+            typed = [np.asarray(_column(col, dt))
+                     for col, dt in zip(raw, dtypes)]
+            yield raw, typed
+            rows = list(islice(cur, chunksize))
+    return
+
+
+# Missing value of each accumulator dtype (None for objects)
+_empty = {"f8": np.nan, "M8[ns]": np.datetime64("NaT", "ns")}
+
+
+def _acc_dtype(dtype):
+    """Accumulator dtype of min/max/first/last for a field's load dtype."""
+    if dtype == "M8[ns]":
+        return "M8[ns]"
+    if dtype is object:
+        return object
+    return "f8"
+
+
+def _grow(a, n, fill):
+    """Extends a per-group array to n groups."""
+    if len(a) >= n:
+        return a
+    extra = np.empty(n - len(a), dtype=a.dtype)
+    extra[:] = fill
+    return np.concatenate([a, extra])
+
+
+def _combine(acc, idx, part, op):
+    """Merges partial minimums/maximums into acc at group positions idx."""
+    current = acc[idx]
+    take = np.asarray(pd.isnull(current))
+    seen = ~take
+    take[seen] = op(part[seen], current[seen])
+    acc[idx[take]] = part[take]
+    return
+
+
+class _Aggregator(object):
+    """Hash aggregation state: a {key: group id} table plus one array per
+    statistic, indexed by group id.
+    """
+    def __init__(self, stats, dtypes):
+        self.groups = {}
+        self.stats = stats
+        self.freq = np.zeros(0, dtype="i8")
+        self.state = {}
+        for field, stat in stats:
+            dtype = _acc_dtype(dtypes[field])
+            if stat in ("SUM", "MEAN"):
+                self.state[(field, "SUM")] = (np.zeros(0, "f8"), 0)
+            if stat in ("COUNT", "MEAN"):
+                self.state[(field, "COUNT")] = (np.zeros(0, "i8"), 0)
+            if stat in ("MIN", "MAX", "FIRST", "LAST"):
+                empty = _empty.get(dtype)
+                self.state[(field, stat)] = (np.zeros(0, dtype), empty)
+            if stat == "UNIQUE":
+                self.state[(field, stat)] = set()
+
+    def update(self, keys, values):
+        """Adds a chunk: keys are hashable per-row group keys, values is a
+        {field: (raw column, typed column)} dict.
+        """
+        groups = self.groups
+        before = len(groups)
+        codes = np.array([groups.setdefault(k, len(groups)) for k in keys],
+                         dtype="i8")
+        n = len(groups)
+        self.freq = _grow(self.freq, n, 0) + np.bincount(codes, minlength=n)
+        for (field, stat), state in self.state.items():
+            raw, typed = values[field]
+            if stat == "UNIQUE":
+                state.update((c, v) for c, v in zip(codes.tolist(), raw)
+                             if v is not None)
+                continue
+            acc = _grow(state[0], n, state[1])
+            valid = ~np.asarray(pd.isnull(typed))
+            if stat == "SUM":
+                acc += np.bincount(codes[valid], minlength=n,
+                                   weights=typed[valid].astype("f8"))
+            elif stat == "COUNT":
+                acc += np.bincount(codes[valid], minlength=n)
+            elif stat in ("MIN", "MAX"):
+                part = pd.Series(typed[valid]).groupby(codes[valid])
+                part = part.min() if stat == "MIN" else part.max()
+                op = np.less if stat == "MIN" else np.greater
+                _combine(acc, part.index.values,
+                         np.asarray(part.values, dtype=acc.dtype), op)
+            elif stat == "FIRST":
+                # Only groups first seen in this chunk
+                uniq, first = np.unique(codes, return_index=True)
+                new = uniq >= before
+                acc[uniq[new]] = typed[first[new]]
+            elif stat == "LAST":
+                uniq, last = np.unique(codes[::-1], return_index=True)
+                acc[uniq] = typed[len(codes) - 1 - last]
+            self.state[(field, stat)] = (acc, state[1])
+        return
+
+    def result(self):
+        """{column name: per-group array} for the requested statistics."""
+        n = len(self.groups)
+        out = []
+        for field, stat in self.stats:
+            name = "{}_{}".format(stat, field)
+            if stat == "UNIQUE":
+                codes = np.array([c for c, v in self.state[(field, stat)]],
+                                 dtype="i8")
+                out.append((name, np.bincount(codes, minlength=n)))
+            elif stat == "MEAN":
+                total = _grow(self.state[(field, "SUM")][0], n, 0)
+                count = _grow(self.state[(field, "COUNT")][0], n, 0)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    out.append((name, np.where(count > 0, total / count,
+                                               np.nan)))
+            else:
+                acc, fill = self.state[(field, stat)]
+                out.append((name, _grow(acc, n, fill)))
+        return out
+
+
+def _parse_stats(stats):
+    """Normalizes statistics to a list of (field, STAT) pairs.
+    Accepts a {field: stat or [stats]} dict or a list of [field, stat] pairs
+    (the statistics_fields format of arcpy's Statistics_analysis).
+    """
+    if isinstance(stats, dict):
+        stats = [(f, s) for f, v in stats.items() for s in _as_list(v)]
+    pairs = []
+    for field, stat in stats:
+        stat = stat.upper()
+        if stat == "NUNIQUE":
+            stat = "UNIQUE"
+        if stat not in STATISTICS:
+            raise ValueError("Unknown statistic '{}'; use one of {}".format(
+                stat, STATISTICS))
+        if (field, stat) not in pairs:
+            pairs.append((field, stat))
+    return pairs
+
+
+def aggregate(fc, by, stats, where=None, chunksize=CHUNKSIZE):
+    """Summarizes fields by one or more case fields in a single cursor pass.
+    Nulls are ignored by SUM, COUNT, MEAN, MIN, MAX and UNIQUE (distinct
+    count); FIRST and LAST take the value of the group's first and last row in
+    cursor order. Rows with NULL keys form their own group.
+    Args:
+        fc (str): name or path of input table or feature class
+        by (str/list): case field(s); an empty list summarizes the whole table
+        stats (dict/list): {field: stat or [stats]} or [[field, stat], ...]
+        where (str): optional where clause applied by the cursor
+        chunksize (int): rows reduced at a time
+    Returns a dataframe indexed by the case fields with a FREQUENCY column and
+    one "<STAT>_<field>" column per statistic, groups in first-seen order.
+    Example:
+        >>> aggregate(parcels, ["Zoning", "Ward"],
+        ...           {"Acres": ["SUM", "MEAN"], "Owner": "UNIQUE"},
+        ...           where="Acres > 0")
+    """
+    by = _as_list(by) if by else []
+    pairs = _parse_stats(stats)
+    fields = list(by)
+    for field, stat in pairs:
+        if field not in fields:
+            fields.append(field)
+    dtypes = dict(zip(fields, _field_dtypes(fc, fields)))
+    agg = _Aggregator(pairs, dtypes)
+    for raw, typed in _iter_columns(fc, fields, chunksize, where):
+        if len(by) == 1:
+            keys = raw[0]
+        elif by:
+            keys = zip(*raw[:len(by)])
+        else:
+            keys = [()] * len(raw[0])
+        agg.update(keys, dict((f, (r, t)) for f, r, t
+                              in zip(fields, raw, typed)))
+    data = [("FREQUENCY", _grow(agg.freq, len(agg.groups), 0))]
+    data.extend(agg.result())
+    df = pd.DataFrame(dict(data), columns=[name for name, _ in data])
+    keys = sorted(agg.groups, key=agg.groups.get)
+    if len(by) == 1:
+        df.index = pd.Index(keys, name=by[0])
+    elif by and keys:
+        df.index = pd.MultiIndex.from_tuples(keys, names=by)
+    elif by:
+        df.index = pd.MultiIndex.from_arrays([[]] * len(by), names=by)
+    return df
+
+
+def groupby(fc, gb_field, summary_field, chunksize=CHUNKSIZE):
+    """Sums summary_field by gb_field in a single cursor pass."""
+    df = aggregate(fc, gb_field, {summary_field: "SUM"}, chunksize=chunksize)
+    df = df[["SUM_{}".format(summary_field)]]
+    df.columns = [summary_field]
+    return df.sort_index()
+
+
+# =============================================================================
+# DUPLICATES
+
+# Distinct keys held in memory by find_duplicates before spilling to disk
+MAX_KEYS = 5000000
+
+
+def _iter_keys(fc, fields, where=None, chunksize=CHUNKSIZE):
+    """Yields chunks of (key, oid) pairs; composite keys are tuples."""
+    with arcpy.da.SearchCursor(fc, ["OID@"] + fields, where) as cur:
+        rows = list(islice(cur, chunksize))
+        while rows:
+            if len(fields) == 1:
+                yield [(row[1], row[0]) for row in rows]
+            else:
+                yield [(row[1:], row[0]) for row in rows]
+            rows = list(islice(cur, chunksize))
+    return
+
+
+def _add_keys(pairs, seen, dups):
+    """Records (key, oid) pairs; keys seen before are added to dups."""
+    for key, oid in pairs:
+        first = seen.setdefault(key, oid)
+        if first != oid:
+            dups.setdefault(key, [first]).append(oid)
+    return
+
+
+class _Partitions(object):
+    """(key, oid) pairs spilled to disk in hash partitions."""
+    def __init__(self, count, folder=None):
+        self.count = count
+        self.folder = tempfile.mkdtemp(prefix="archacks_dups_", dir=folder)
+        self.files = [open(os.path.join(self.folder, "{}.pkl".format(i)),
+                           "wb") for i in range(count)]
+
+    def write(self, pairs):
+        parts = [[] for _ in range(self.count)]
+        for pair in pairs:
+            parts[hash(pair[0]) % self.count].append(pair)
+        for f, part in zip(self.files, parts):
+            if part:
+                pickle.dump(part, f, protocol=2)
+        return
+
+    def read(self, i):
+        """Yields the pair lists written to partition i."""
+        self.files[i].flush()
+        with open(os.path.join(self.folder, "{}.pkl".format(i)), "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+        return
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+        return
+
+
+def find_duplicates(fc, fields, where=None, max_keys=MAX_KEYS, partitions=64,
+                    spill_dir=None, chunksize=CHUNKSIZE):
+    """Finds the values (or combinations of values) that occur on more than
+    one row, in a single cursor pass.
+    Keys are held in memory until more than max_keys distinct keys are seen;
+    after that all (key, OID) pairs are spilled to disk in hash partitions
+    that are then checked one at a time, bounding memory to about
+    max_keys plus a single partition. NULLs are compared as values.
+    Args:
+        fc (str): name or path of input table or feature class
+        fields (str/list): field(s) forming the key
+        where (str): optional where clause applied by the cursor
+        max_keys (int): distinct keys held in memory before spilling
+        partitions (int): number of hash partitions when spilling
+        spill_dir (str): folder for the partition files; default temp folder
+        chunksize (int): rows read at a time
+    Returns a {key: [OIDs]} dict of the duplicated keys (tuples for more than
+    one field), OIDs in ascending order.
+    Example:
+        >>> dups = find_duplicates(parcels, "ParcelID")
+        >>> dups
+        {u'0401203': [118, 2377]}
+    """
+    fields = _as_list(fields)
+    seen = {}
+    dups = {}
+    spill = None
+    try:
+        for pairs in _iter_keys(fc, fields, where, chunksize):
+            if spill is not None:
+                spill.write(pairs)
+                continue
+            _add_keys(pairs, seen, dups)
+            if len(seen) > max_keys:
+                # Move everything read so far to disk; duplicates are found
+                #  again per partition
+                spill = _Partitions(partitions, spill_dir)
+                spill.write([(k, oid) for k, oids in dups.items()
+                             for oid in oids[1:]])
+                spill.write(seen.items())
+                seen = {}
+                dups = {}
+        if spill is not None:
+            for i in range(spill.count):
+                part_seen = {}
+                for pairs in spill.read(i):
+                    _add_keys(pairs, part_seen, dups)
+    finally:
+        if spill is not None:
+            spill.close()
+    for oids in dups.values():
+        oids.sort()
+    return dups
+
+
+def is_unique(fc, fields, where=None, chunksize=CHUNKSIZE):
+    """Checks if fields of a feature class have all unique values
+    (combinations of values for more than one field); stops at the first
+    duplicate.
+    """
+    fields = _as_list(fields)
+    seen = set()
+    for pairs in _iter_keys(fc, fields, where, chunksize):
+        count = len(seen)
+        seen.update(key for key, oid in pairs)
+        if len(seen) - count != len(pairs):
+            return False
+    return True
+
+
+# =============================================================================
+# SKETCHES
+
+def _hashes(values):
+    """64-bit hashes of a column; numbers hash alike whatever their dtype."""
+    values = np.asarray(values)
+    if values.dtype.kind in "iufb":
+        values = values.astype("f8")
+    elif values.dtype.kind == "M":
+        values = values.astype("M8[ns]").view("i8")
+    else:
+        values = values.astype(object)
+    return pd.util.hash_array(values)
+
+
+def _clz64(x):
+    """Leading zero bits of each uint64."""
+    x = x.copy()
+    n = np.zeros(len(x), dtype="i8")
+    for s in (32, 16, 8, 4, 2, 1):
+        m = x < np.uint64(1 << (64 - s))
+        n[m] += s
+        x[m] <<= np.uint64(s)
+    n[x == 0] = 64
+    return n
+
+
+class HyperLogLog(object):
+    """Distinct count estimate in 2 ** p bytes (standard error 1.04/2**(p/2),
+    i.e. 0.8% for p=14).
+    """
+    def __init__(self, p=14):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype="u1")
+
+    def update(self, hashes):
+        idx = (hashes >> np.uint64(64 - self.p)).astype("i8")
+        rank = np.minimum(_clz64(hashes << np.uint64(self.p)) + 1,
+                          64 - self.p + 1)
+        np.maximum.at(self.registers, idx, rank.astype("u1"))
+        return
+
+    def count(self):
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(2.0 ** -self.registers.astype("f8"))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            # Small cardinalities: linear counting
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+class CountMin(object):
+    """Frequency estimates (never under the true count) in a depth x width
+    table of counters.
+    """
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.table = np.zeros((depth, width), dtype="i8")
+
+    def _columns(self, hashes):
+        # Double hashing: the i-th row uses h1 + i * h2
+        h1 = (hashes & np.uint64(0xFFFFFFFF)).astype("i8")
+        h2 = (hashes >> np.uint64(32)).astype("i8")
+        return [(h1 + i * h2) % self.width for i in range(len(self.table))]
+
+    def update(self, hashes):
+        for row, cols in zip(self.table, self._columns(hashes)):
+            row += np.bincount(cols, minlength=self.width)
+        return
+
+    def estimate(self, hashes):
+        return np.min([row[cols] for row, cols
+                       in zip(self.table, self._columns(hashes))], axis=0)
+
+
+class FrequentItems(object):
+    """Misra-Gries (space-saving) summary: keeps at most `capacity` candidate
+    values; any value occurring more than n / (capacity + 1) times is kept.
+    """
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counters = {}
+
+    def update(self, counts):
+        """Adds a {value: count} dict (e.g. a Counter of a chunk)."""
+        counters = self.counters
+        for value, count in counts.items():
+            counters[value] = counters.get(value, 0) + count
+        if len(counters) > self.capacity:
+            kth = sorted(counters.values(), reverse=True)[self.capacity]
+            self.counters = dict((v, c - kth) for v, c in counters.items()
+                                 if c > kth)
+        return
+
+
+class QuantileSketch(object):
+    """KLL quantile sketch: rank error of about 1.7 / k using roughly 3k
+    stored values.
+    """
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.levels = [np.zeros(0, dtype="f8")]
+        self._rng = np.random.RandomState(seed)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(2, int(np.ceil(self.k * (2.0 / 3) ** depth)))
+
+    def update(self, values):
+        self.levels[0] = np.concatenate([self.levels[0],
+                                         np.asarray(values, dtype="f8")])
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) <= self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self.levels):
+                self.levels.append(np.zeros(0, dtype="f8"))
+            # Sort and promote every other item (random offset) a level up
+            items = np.sort(items)
+            keep = items[:len(items) % 2]
+            items = items[len(keep):]
+            promoted = items[self._rng.randint(2)::2]
+            self.levels[level] = keep
+            self.levels[level + 1] = np.concatenate(
+                [self.levels[level + 1], promoted])
+            # Capacities shrink as levels are added; recheck from the bottom
+            level = 0
+        return
+
+    def quantiles(self, qs):
+        items = np.concatenate(self.levels)
+        if not len(items):
+            return [np.nan] * len(qs)
+        weights = np.concatenate([np.repeat(2.0 ** i, len(a))
+                                  for i, a in enumerate(self.levels)])
+        order = np.argsort(items, kind="mergesort")
+        items = items[order]
+        cum = np.cumsum(weights[order])
+        ranks = np.clip(np.asarray(qs) * cum[-1], 0, cum[-1])
+        idx = np.minimum(np.searchsorted(cum, ranks), len(items) - 1)
+        return items[idx].tolist()
+
+
+# =============================================================================
+# PROFILING
+
+# Field types without meaningful values to profile
+_UNPROFILED = ("Geometry", "Blob", "Raster")
+
+
+class _FieldProfile(object):
+    """Fixed-size running profile of one field."""
+    def __init__(self, field, dtype, top, quantiles):
+        self.field = field
+        self.dtype = dtype
+        self.top = top
+        self.qs = quantiles
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.numbers = 0
+        self.types = set()
+        self.hll = HyperLogLog()
+        self.cms = CountMin()
+        self.frequent = FrequentItems(max(100, 10 * top))
+        self.quantile = QuantileSketch()
+
+    def update(self, raw, typed):
+        self.count += len(raw)
+        valid = ~np.asarray(pd.isnull(typed))
+        values = typed[valid]
+        self.nulls += len(raw) - len(values)
+        self.types.update(t.__name__ for t in set(map(type, raw)))
+        if not len(values):
+            return
+        try:
+            low, high = values.min(), values.max()
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+        except TypeError:
+            # Mixed, unorderable types
+            pass
+        hashes = _hashes(values)
+        self.hll.update(hashes)
+        self.cms.update(hashes)
+        self.frequent.update(Counter(v for v in raw if v is not None))
+        if values.dtype.kind in "iuf":
+            self.sum += values.sum(dtype="f8")
+            self.numbers += len(values)
+            self.quantile.update(values)
+        elif values.dtype.kind == "M":
+            self.quantile.update(values.astype("M8[ns]").view("i8"))
+        return
+
+    def result(self):
+        out = OrderedDict([
+            ("types", sorted(self.types)), ("count", self.count),
+            ("nulls", self.nulls), ("min", self.min), ("max", self.max),
+            ("mean", self.sum / self.numbers if self.numbers else None),
+            ("distinct", self.hll.count() if self.count > self.nulls else 0)])
+        candidates = list(self.frequent.counters.keys())
+        top = []
+        if candidates:
+            counts = self.cms.estimate(_hashes(
+                np.asarray(_column(candidates, self.dtype))))
+            top = sorted(zip(candidates, counts.tolist()),
+                         key=lambda x: -x[1])[:self.top]
+        out["top"] = top
+        values = self.quantile.quantiles(self.qs)
+        if self.dtype == "M8[ns]":
+            out["min"], out["max"] = pd.Timestamp(self.min), \
+                pd.Timestamp(self.max)
+            values = [pd.NaT if np.isnan(v) else pd.Timestamp(int(v))
+                      for v in values]
+        elif self.numbers == 0:
+            values = [None] * len(self.qs)
+        for q, v in zip(self.qs, values):
+            out["{:g}%".format(q * 100)] = v
+        return out
+
+
+def profile_table(fc, fields=["*"], top=5, quantiles=(0.25, 0.5, 0.75),
+                  where=None, chunksize=CHUNKSIZE):
+    """Profiles fields in a single cursor pass with fixed memory per field.
+    Distinct counts (HyperLogLog), top values (Misra-Gries candidates counted
+    by a count-min sketch) and quantiles (KLL; numeric and date fields) are
+    approximate; count, nulls, min, max, mean and types are exact.
+    Args:
+        fc (str): name or path of input table or feature class
+        fields (list): fields to profile; '*' profiles all but geometry, blob
+            and raster fields
+        top (int): number of most frequent values to report
+        quantiles (tuple): quantiles to estimate (0 to 1)
+        where (str): optional where clause applied by the cursor
+        chunksize (int): rows read at a time
+    Returns a dataframe with one row per field.
+    Example:
+        >>> profile_table(parcels, ["Zoning", "Acres"])[["nulls", "distinct"]]
+    """
+    if fields == ["*"] or fields == "*":
+        fields = [f.name for f in METADATA.describe(fc).fields
+                  if f.type not in _UNPROFILED]
+    fields = _as_list(fields)
+    profiles = [_FieldProfile(f, dt, top, quantiles) for f, dt
+                in zip(fields, _field_dtypes(fc, fields))]
+    for raw, typed in _iter_columns(fc, fields, chunksize, where):
+        for profile, r, t in zip(profiles, raw, typed):
+            profile.update(r, t)
+    return pd.DataFrame([p.result() for p in profiles],
+                        index=pd.Index(fields, name="field"))
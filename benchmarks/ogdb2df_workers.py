@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+ogdb2df_workers.py -- Scaling of ogdb2df with the number of worker processes.
+
+Reads the same FileGDB layer with workers=1, 2, 4, ... up to --max-workers and
+prints rows/s and the speedup over a single process.
+
+Use:
+    python ogdb2df_workers.py C:/workspace/city.gdb/Parcels --max-workers 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# The package modules are imported directly from this checkout
+PKG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PKG_DIR)
+
+try:
+    import arcpy
+except ImportError:
+    # ogdb2df reads through GDAL; _core only needs arcpy to import
+    import _arcemu
+    arcpy = _arcemu.install()
+
+import _core
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("fc_path", help="path to a layer in a FileGDB")
+    parser.add_argument("--fields", nargs="*", default=["*"])
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    workers = 1
+    base = None
+    print("{:>8} {:>12} {:>14} {:>8}".format(
+        "workers", "seconds", "rows/s", "speedup"))
+    while workers <= args.max_workers:
+        best = None
+        for _ in range(args.repeat):
+            start = time.time()
+            df = _core.ogdb2df(args.fc_path, args.fields, workers=workers)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        if base is None:
+            base = best
+        print("{:>8} {:>12.3f} {:>14,.0f} {:>8.2f}".format(
+            workers, best, len(df) / best, base / best))
+        workers *= 2
+    return
+
+
+if __name__ == "__main__":
+    main()
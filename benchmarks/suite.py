@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+suite.py -- Benchmarks for the ArcHacks table I/O paths.
+
+Generates synthetic tables of configurable size and width and times df2tbl,
+tbl2df, ogdb2df, fill_na, groupby, aggregate, sum_field, is_unique,
+find_duplicates and profile_table on them, and spatial_field_calc,
+spatial_index and near_table on a point feature class of the same size (with
+a grid of polygons), reporting
+rows/s and peak memory (Python/NumPy allocations, via tracemalloc).
+Results are saved as JSON so runs can be compared.
+
+Runs headless: when arcpy is not installed the NumPy-backed stand-in
+(_arcemu) is used. The synthetic table is also written through OGR (FileGDB
+where the installed GDAL can create one, else GeoPackage) when GDAL is
+available; ogdb2df is only timed against a FileGDB.
+
+Use:
+    python benchmarks/suite.py --rows 10000 100000 --width 12 --out run.json
+    python benchmarks/suite.py --compare baseline.json run.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import numpy as np
+import pandas as pd
+
+# The package modules are imported directly from this checkout
+PKG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PKG_DIR)
+
+try:
+    import arcpy
+    BACKEND = "arcpy"
+except ImportError:
+    import _arcemu
+    arcpy = _arcemu.install()
+    BACKEND = "_arcemu"
+
+import _core
+import _spatial
+import _stats
+from _core import ogr
+
+
+# =============================================================================
+# SYNTHETIC DATA
+
+# Column kinds cycled through to reach the requested width
+KINDS = ["int", "float", "text", "date"]
+
+
+def make_frame(rows, width, null_frac=0.05, seed=0):
+    """Synthetic dataframe: a unique 'key', a 100-group 'grp' column, then
+    int, float, text and date columns (with NULLs) up to width columns.
+    """
+    rng = np.random.RandomState(seed)
+    cols = OrderedDict()
+    cols["key"] = np.arange(rows, dtype="i4")
+    cols["grp"] = rng.randint(0, 100, rows).astype("i4")
+    for i in range(max(0, width - 2)):
+        kind = KINDS[i % len(KINDS)]
+        nulls = rng.rand(rows) < null_frac
+        if kind == "int":
+            values = rng.randint(0, 10 ** 6, rows).astype("i4")
+        elif kind == "float":
+            values = rng.rand(rows) * 1000
+            values[nulls] = np.nan
+        elif kind == "text":
+            values = np.array(["v{:06d}".format(v) for v
+                               in rng.randint(0, 10 ** 6, rows)], dtype=object)
+            values[nulls] = None
+        else:
+            days = rng.randint(0, 7000, rows).astype("m8[D]")
+            values = (np.datetime64("2000-01-01") + days).astype("M8[us]")
+            values[nulls] = np.datetime64("NaT")
+        cols["{}{}".format(kind, i)] = values
+    return pd.DataFrame(cols)
+
+
+def make_features(rows, name, seed=0):
+    """Point features (with a 'value' field) and a grid of square polygons
+    holding about 20 points each; returns their paths.
+    """
+    rng = np.random.RandomState(seed)
+    side = max(1, int(np.sqrt(rows / 20.0)))
+    points = "in_memory/{}_pts".format(name)
+    grid = "in_memory/{}_grid".format(name)
+    for path in (points, grid):
+        if arcpy.Exists(path):
+            arcpy.Delete_management(path)
+    arcpy.CreateFeatureclass_management("in_memory", points.split("/")[1],
+                                        "POINT")
+    arcpy.AddField_management(points, "value", "LONG")
+    xy = rng.rand(rows, 2) * side
+    values = rng.randint(0, 100, rows)
+    with arcpy.da.InsertCursor(points, ["SHAPE@XY", "value"]) as cur:
+        for (x, y), v in zip(xy.tolist(), values.tolist()):
+            cur.insertRow([(x, y), v])
+    arcpy.CreateFeatureclass_management("in_memory", grid.split("/")[1],
+                                        "POLYGON")
+    with arcpy.da.InsertCursor(grid, ["SHAPE@"]) as cur:
+        for i in range(side):
+            for j in range(side):
+                ring = [arcpy.Point(i, j), arcpy.Point(i, j + 1),
+                        arcpy.Point(i + 1, j + 1), arcpy.Point(i + 1, j)]
+                cur.insertRow([arcpy.Polygon(arcpy.Array(ring))])
+    return points, grid
+
+
+def write_ogr(df, folder):
+    """Writes df through OGR; returns (driver name, layer path) or None."""
+    if ogr is None:
+        return None
+    for driver_name, ext in (("OpenFileGDB", ".gdb"), ("GPKG", ".gpkg")):
+        driver = ogr.GetDriverByName(driver_name)
+        if driver is None or driver.GetMetadataItem("DCAP_CREATE") != "YES":
+            continue
+        path = os.path.join(folder, "bench" + ext)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        ds = driver.CreateDataSource(path)
+        lyr = ds.CreateLayer("bench", geom_type=ogr.wkbNone)
+        convert = []
+        for col in df.columns:
+            kind = df[col].dtype.kind
+            if kind in "iu":
+                lyr.CreateField(ogr.FieldDefn(col, ogr.OFTInteger))
+                convert.append(int)
+            elif kind == "f":
+                lyr.CreateField(ogr.FieldDefn(col, ogr.OFTReal))
+                convert.append(float)
+            elif kind == "M":
+                lyr.CreateField(ogr.FieldDefn(col, ogr.OFTDateTime))
+                convert.append(lambda v: v.strftime("%Y/%m/%d %H:%M:%S"))
+            else:
+                lyr.CreateField(ogr.FieldDefn(col, ogr.OFTString))
+                convert.append(str)
+        defn = lyr.GetLayerDefn()
+        nulls = df.isnull().values
+        lyr.StartTransaction()
+        for r, row in enumerate(df.itertuples(index=False)):
+            feat = ogr.Feature(defn)
+            for i, value in enumerate(row):
+                if not nulls[r, i]:
+                    feat.SetField(i, convert[i](value))
+            lyr.CreateFeature(feat)
+        lyr.CommitTransaction()
+        ds = None
+        return driver_name, "{}/bench".format(path)
+    return None
+
+
+# =============================================================================
+# MEASUREMENT
+
+def measure(func, setup=None, repeat=3, memory=True):
+    """Best wall time of func over repeat runs and its peak memory (bytes).
+    Memory is measured on a separate run so tracing does not skew timings.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = timer()
+        func()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if memory and tracemalloc is not None:
+        if setup:
+            setup()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+
+def benchmarks(df, tbl, tmp):
+    """Yields (name, func, setup) for every benchmark on one table size."""
+    floats = [c for c in df.columns if c.startswith("float")]
+    summary = floats[0] if floats else "key"
+
+    def load():
+        _core.df2tbl(df, tbl)
+
+    yield "df2tbl", load, None
+    yield "tbl2df", lambda: _core.tbl2df(tbl), None
+    yield "groupby", lambda: _stats.groupby(tbl, "grp", summary), None
+    yield "aggregate", lambda: _stats.aggregate(
+        tbl, "grp", {summary: ["SUM", "MEAN", "MIN", "MAX", "UNIQUE"]}), None
+    yield "sum_field", lambda: _core.sum_field(tbl, summary), None
+    yield "is_unique", lambda: _stats.is_unique(tbl, "key"), None
+    yield "find_duplicates", lambda: _stats.find_duplicates(
+        tbl, ["grp", "key"]), None
+    yield "profile_table", lambda: _stats.profile_table(tbl), None
+    if floats:
+        # fill_na edits the table, so each run starts from a fresh copy
+        yield "fill_na", lambda: _core.fill_na(tbl, floats, 0), load
+    points, grid = make_features(len(df), tbl.split("/")[-1])
+    yield "spatial_calc", lambda: _core.spatial_field_calc(
+        grid, None, "total", points, "value", "SUM", default_value=0), None
+    yield "spatial_index", lambda: _spatial.spatial_index(points), None
+    yield "near_table", lambda: _spatial.near_table(points, grid, k=3), None
+    written = {}
+
+    def ogr_write():
+        written["out"] = write_ogr(df, tmp)
+
+    if ogr is not None:
+        yield "ogr_write", ogr_write, None
+        # Resumed after ogr_write has been measured
+        if written.get("out") and written["out"][0] == "OpenFileGDB":
+            gdb_fc = written["out"][1]
+            yield "ogdb2df", lambda: _core.ogdb2df(gdb_fc), None
+
+
+def run(rows_list, width, repeat, memory, out_path):
+    tmp = tempfile.mkdtemp(prefix="archacks_bench_")
+    results = []
+    print("{:<16} {:>10} {:>6} {:>10} {:>14} {:>10}".format(
+        "function", "rows", "width", "seconds", "rows/s", "peak MB"))
+    try:
+        for rows in rows_list:
+            df = make_frame(rows, width)
+            tbl = "in_memory/bench_{}_{}".format(rows, width)
+            for name, func, setup in benchmarks(df, tbl, tmp):
+                seconds, peak = measure(func, setup, repeat, memory)
+                result = OrderedDict([
+                    ("function", name), ("rows", rows), ("width", width),
+                    ("seconds", seconds),
+                    ("rows_per_s", rows / seconds if seconds else None),
+                    ("peak_bytes", peak)])
+                results.append(result)
+                print("{:<16} {:>10} {:>6} {:>10.4f} {:>14,.0f} {:>10}".format(
+                    name, rows, width, seconds, result["rows_per_s"] or 0,
+                    "-" if peak is None else "{:.1f}".format(peak / 1e6)))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    meta = OrderedDict([
+        ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("backend", BACKEND),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("numpy", np.__version__),
+        ("pandas", pd.__version__),
+        ("gdal", getattr(sys.modules.get("osgeo"), "__version__", None)),
+        ("repeat", repeat)])
+    if out_path:
+        with open(out_path, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+    return results
+
+
+def compare(old_path, new_path):
+    """Prints the rows/s ratio (new / old) of each benchmark in both runs."""
+    runs = []
+    for path in (old_path, new_path):
+        with open(path, "r") as f:
+            runs.append(dict(
+                ((r["function"], r["rows"], r["width"]), r)
+                for r in json.load(f)["results"]))
+    old, new = runs
+    print("{:<16} {:>10} {:>6} {:>14} {:>14} {:>8}".format(
+        "function", "rows", "width", "old rows/s", "new rows/s", "ratio"))
+    for key in sorted(set(old) & set(new)):
+        a, b = old[key]["rows_per_s"], new[key]["rows_per_s"]
+        print("{:<16} {:>10} {:>6} {:>14,.0f} {:>14,.0f} {:>8.2f}".format(
+            key[0], key[1], key[2], a, b, b / a))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the ArcHacks table I/O paths.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--width", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the peak memory runs")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved runs instead of running")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args.rows, args.width, args.repeat, not args.no_memory, args.out)
+    return
+
+
+if __name__ == "__main__":
+    main()